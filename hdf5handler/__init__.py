@@ -3,3 +3,9 @@ Context Manager to write to HDF5 using h5py.
 """
 
 from .handler import HDF5Handler
+from .reader import chunk_stats, select_chunks, iter_chunks, RunLengthReader
+from .reader import memmap, map_chunks
+from .verify import verify
+from .summary import describe, summarize
+from .checkpoint import recover
+from .rawfile import RawFile, raw_to_hdf5
@@ -1,5 +1,253 @@
 #!/usr/bin/env python
+"""
+Benchmarks of the HDF5Handler. Run with:
+
+    $ python -m hdf5handler.benchmarks
+
+"""
 
 #TODO: write a benchmark module to test different chunksizes and show that a
 # smart choice of chunksize can make a big performance difference.
 
+import os
+import time
+import shutil
+import tempfile
+import threading
+import numpy
+import h5py
+
+from .handler import HDF5Handler
+
+
+def remove(path):
+    """ Removes a file or a directory. """
+    if os.path.isdir(path):
+        shutil.rmtree(path)
+    elif os.path.exists(path):
+        os.remove(path)
+
+
+def time_puts(data, npaths=1, nputs=100000, handler_kwargs=None, **kwargs):
+    """
+    Times nputs calls of handler.put(data, path) spread over npaths paths.
+
+    Parameters
+    ----------
+    data : any valid data. See HDF5Handler.put.__doc__
+
+    npaths : int
+        Number of datasets to put to (round-robin).
+
+    nputs : int
+        Total number of puts.
+
+    handler_kwargs : dict
+        Keyword arguments for HDF5Handler.
+
+    **kwargs : Keyword arguments for HDF5Handler.put.
+
+    Return
+    ------
+    The number of puts per second, including opening and closing the file.
+    """
+    handler_kwargs = handler_kwargs or dict()
+    paths = ['dset{}'.format(i) for i in range(npaths)]
+    directory = tempfile.mkdtemp()
+    filename = os.path.join(directory, 'benchmark.hdf5')
+
+    try:
+        start = time.time()
+        with HDF5Handler(filename, **handler_kwargs) as handler:
+            for i in range(nputs // npaths):
+                for path in paths:
+                    handler.put(data, path, **kwargs)
+        return nputs / (time.time() - start)
+    finally:
+        remove(directory)
+
+
+def report(title, results):
+    """ Prints the results {label: puts per second} of a benchmark. """
+    print(title)
+    for label, rate in results:
+        print("    {:<40} {:>12.0f} puts/s".format(label, rate))
+    print("")
+
+
+def benchmark_backends(nputs=100000):
+    """ Compares the put rate of the 'hdf5' and 'raw' backends. """
+    cases = [('scalar, 1 path', 1.0, 1),
+             ('scalar, 100 paths', 1.0, 100),
+             ('ndarray(100), 1 path', numpy.ones(100), 1),
+             ('ndarray(100), 100 paths', numpy.ones(100), 100)]
+
+    results = list()
+    for label, data, npaths in cases:
+        for backend in ('hdf5', 'raw'):
+            rate = time_puts(data, npaths, nputs,
+                             handler_kwargs=dict(backend=backend))
+            results.append(('{:<7} {}'.format(backend, label), rate))
+
+    report("Backends", results)
+
+
+def time_threaded_puts(data, nthreads, nputs=100000, global_lock=False,
+                       **kwargs):
+    """
+    Times nputs calls of handler.put(data, path), divided over nthreads
+    threads that each put to their own path.
+
+    Parameters
+    ----------
+    global_lock : bool
+        Wrap every put in a single lock with a handler that is not threadsafe,
+        instead of using HDF5Handler(..., threadsafe=True).
+
+    Return
+    ------
+    The number of puts per second, including opening and closing the file.
+    """
+    directory = tempfile.mkdtemp()
+    filename = os.path.join(directory, 'benchmark.hdf5')
+    lock = threading.Lock()
+
+    def producer(handler, path):
+        for i in range(nputs // nthreads):
+            if global_lock:
+                with lock:
+                    handler.put(data, path, **kwargs)
+            else:
+                handler.put(data, path, **kwargs)
+
+    try:
+        start = time.time()
+        with HDF5Handler(filename, threadsafe=not global_lock) as handler:
+            threads = [threading.Thread(target=producer,
+                                        args=(handler, 'dset{}'.format(i)))
+                       for i in range(nthreads)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        return nputs / (time.time() - start)
+    finally:
+        remove(directory)
+
+
+def benchmark_threads(nputs=100000):
+    """
+    Compares threadsafe=True to a global lock around every put. Neither
+    scales with the number of threads, since h5py serializes HDF5 calls.
+    """
+    results = list()
+    for nthreads in (1, 2, 4, 8):
+        for global_lock in (True, False):
+            rate = time_threaded_puts(numpy.ones(100), nthreads, nputs,
+                                      global_lock=global_lock)
+            label = '{} threads, {}'.format(
+                nthreads, 'global lock' if global_lock else 'threadsafe')
+            results.append((label, rate))
+
+    report("Threads", results)
+
+
+def time_file_space(ndatasets=1000, nrows=2500, **handler_kwargs):
+    """
+    Writes ndatasets datasets of nrows scalars (round-robin, as a wide log
+    would), then reopens the file and reads every dataset.
+
+    Return
+    ------
+    (puts per second, seconds to reopen and read all datasets, file size)
+    """
+    directory = tempfile.mkdtemp()
+    filename = os.path.join(directory, 'benchmark.hdf5')
+    paths = ['grp{}/dset{}'.format(i % 10, i) for i in range(ndatasets)]
+
+    try:
+        start = time.time()
+        with HDF5Handler(filename, **handler_kwargs) as handler:
+            for i in range(nrows):
+                for path in paths:
+                    handler.put(1.0, path, chunksize=100, blockfactor=5)
+        rate = ndatasets*nrows / (time.time() - start)
+
+        # The file was closed, so HDF5's caches are cold. The OS page cache
+        # may still hold the file.
+        start = time.time()
+        with h5py.File(filename, 'r') as f:
+            for path in paths:
+                f[path][...]
+        readtime = time.time() - start
+
+        return rate, readtime, os.path.getsize(filename)
+    finally:
+        remove(directory)
+
+
+def benchmark_file_space(ndatasets=1000, nrows=2500):
+    """
+    Compares the paged file space strategy to HDF5's defaults.
+    """
+    cases = [('paged', dict(fs_strategy='page', page_buf_size=2**22,
+                            meta_block_size=2**16)),
+             ('HDF5 defaults (default)', dict())]
+
+    print("File space strategy ({} datasets)".format(ndatasets))
+    for label, kwargs in cases:
+        rate, readtime, size = time_file_space(ndatasets, nrows, **kwargs)
+        print("    {:<24} {:>10.0f} puts/s {:>8.3f} s to read {:>8.1f} MiB"
+              .format(label, rate, readtime, size / 2.0**20))
+    print("")
+
+
+def time_put_table(nrows=100000, **kwargs):
+    """
+    Times put_table of a single column of nrows scalars.
+
+    Return
+    ------
+    The number of rows per second, including opening and closing the file.
+    """
+    directory = tempfile.mkdtemp()
+    filename = os.path.join(directory, 'benchmark.hdf5')
+    column = numpy.ones(nrows)
+
+    try:
+        start = time.time()
+        with HDF5Handler(filename) as handler:
+            handler.put_table({'dset': column}, 'grp', **kwargs)
+        return nrows / (time.time() - start)
+    finally:
+        remove(directory)
+
+
+def benchmark_scalars(nputs=1000000):
+    """
+    Measures puts of scalars of several types, next to put_table. A put is
+    dominated by the overhead of the call itself, so streams that are
+    available in bulk should use put_table.
+    """
+    cases = [('python float', 1.0, dict()),
+             ('numpy.float64', numpy.float64(1.0), dict()),
+             ('python int, dtype=int64', 1, dict(dtype='int64')),
+             ('python float, stats=True', 1.0, dict(stats=True))]
+
+    results = list()
+    for label, data, kwargs in cases:
+        results.append((label, time_puts(data, 1, nputs, **kwargs)))
+    results.append(('put_table (rows/s)', time_put_table(nputs)))
+
+    report("Scalars", results)
+
+
+def main():
+    benchmark_scalars()
+    benchmark_backends()
+    benchmark_threads()
+    benchmark_file_space()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,401 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Crash recovery of files written with HDF5Handler(..., checkpoint=n).
+
+Every n chunks, the handler records the number of valid rows of a dataset in
+its VALID_LENGTH attribute and flushes the file. Run-length encoded groups
+write their buffered changes first, every n*chunksize puts. With wal=True,
+the rows put since the last checkpoint are also appended to a write-ahead
+log, one file per dataset in the directory <filename>.wal:
+
+    mydata.hdf5
+    mydata.hdf5.wal
+    ├── grp%2Fdset.wal     <-- raw rows of /grp/dset since its checkpoint
+    └── scalars.wal
+
+If the writer dies, recover trims every dataset to its valid length (which
+drops the preallocated, unwritten tail) and appends the rows in its log, as
+changes for run-length encoded groups:
+
+    $ hdf5handler recover mydata.hdf5
+
+Only metadata and the logs are read, so recovery does not scan the file.
+"""
+
+import os
+import struct
+import shutil
+import numpy
+import h5py
+
+try:
+    from urllib.parse import quote, unquote
+except ImportError:
+    from urllib import quote, unquote
+
+from .sidecars import METADATA_GROUP, ChunkStats, ChunkChecksums
+from .sidecars import sidecar_path
+
+VALID_LENGTH = 'valid_length'
+WAL_EXTENSION = '.wal'
+HEADER_DTYPE = numpy.dtype('<i8')
+
+
+def wal_directory(filename):
+    """ The directory of the write-ahead logs of filename. """
+    return filename + WAL_EXTENSION
+
+
+def wal_path(filename, dset_name):
+    """ The path of the write-ahead log of the dataset dset_name. """
+    name = quote(dset_name.strip('/'), safe='') + WAL_EXTENSION
+    return os.path.join(wal_directory(filename), name)
+
+
+class WriteAheadLog(object):
+    """
+    An append-only file with the raw rows of a dataset, in the dtype of the
+    dataset, after a header with the row number of the first row (int64).
+    Every write is a single os.write, which is not buffered by the process,
+    so the rows survive if the process dies (but not if the operating system
+    does).
+    """
+    def __init__(self, filename, dset_name, dtype):
+        """
+        Parameters
+        ----------
+        filename : str
+            The HDF5 file.
+
+        dset_name : str
+            The (absolute) name of the h5py dataset.
+
+        dtype : numpy dtype of the dataset.
+        """
+        directory = wal_directory(filename)
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+        self.path = wal_path(filename, dset_name)
+        self.dtype = numpy.dtype(dtype)
+        flags = os.O_WRONLY | os.O_CREAT | os.O_TRUNC | os.O_APPEND | \
+                getattr(os, 'O_BINARY', 0)
+        self.fd = os.open(self.path, flags)
+        self.reset(0)
+
+    def write(self, rows):
+        """ Appends a row, or a sequence of rows. """
+        with numpy.errstate(invalid='ignore', over='ignore'):
+            rows = numpy.asarray(rows).astype(self.dtype)
+        os.write(self.fd, rows.tobytes())
+
+    def reset(self, begin, rows=()):
+        """ Empties the log and writes rows, the first of which is row begin. """
+        os.ftruncate(self.fd, 0)
+        os.write(self.fd, numpy.array(begin, HEADER_DTYPE).tobytes())
+        if len(rows):
+            self.write(rows)
+
+    def close(self):
+        os.close(self.fd)
+
+
+def read_log(path, dset):
+    """
+    Returns (begin, rows) of the write-ahead log at path, of the dataset
+    dset, where begin is the row number of the first row. An incomplete last
+    row (of a write that was interrupted) is ignored.
+    """
+    rowshape = dset.shape[1:]
+    rowsize = dset.dtype.itemsize * int(numpy.prod(rowshape))
+    with open(path, 'rb') as logfile:
+        data = logfile.read()
+
+    size = HEADER_DTYPE.itemsize
+    if len(data) < size:
+        begin, data = 0, b''
+    else:
+        begin, data = int(numpy.frombuffer(data[:size], HEADER_DTYPE)[0]), \
+                      data[size:]
+
+    nrows = len(data) // rowsize
+    rows = numpy.frombuffer(data[:nrows*rowsize], dtype=dset.dtype)
+    return begin, rows.reshape((nrows,) + rowshape)
+
+
+def lookup3(data, initval=0):
+    """
+    Bob Jenkins' lookup3 hash (hashlittle), which HDF5 uses to checksum its
+    metadata, of the bytes data.
+    """
+    mask = 0xffffffff
+
+    def rot(x, k):
+        return ((x << k) | (x >> (32 - k))) & mask
+
+    length = len(data)
+    a = b = c = (0xdeadbeef + length + initval) & mask
+    data = bytearray(data)
+    if length == 0:
+        return c
+
+    tail = length - ((length - 1) % 12 + 1) # THE LAST 1 TO 12 BYTES
+    padded = bytes(data + bytearray(tail + 12 - length))
+    for offset in range(0, tail + 12, 12):
+        x, y, z = struct.unpack('<3I', padded[offset:offset+12])
+        a = (a + x) & mask
+        b = (b + y) & mask
+        c = (c + z) & mask
+        if offset == tail:
+            break
+
+        a = (a - c) & mask; a ^= rot(c, 4);  c = (c + b) & mask
+        b = (b - a) & mask; b ^= rot(a, 6);  a = (a + c) & mask
+        c = (c - b) & mask; c ^= rot(b, 8);  b = (b + a) & mask
+        a = (a - c) & mask; a ^= rot(c, 16); c = (c + b) & mask
+        b = (b - a) & mask; b ^= rot(a, 19); a = (a + c) & mask
+        c = (c - b) & mask; c ^= rot(b, 4);  b = (b + a) & mask
+
+    c ^= b; c = (c - rot(b, 14)) & mask
+    a ^= c; a = (a - rot(c, 11)) & mask
+    b ^= a; b = (b - rot(a, 25)) & mask
+    c ^= b; c = (c - rot(b, 16)) & mask
+    a ^= c; a = (a - rot(c, 4)) & mask
+    b ^= a; b = (b - rot(a, 14)) & mask
+    c ^= b; c = (c - rot(b, 24)) & mask
+    return c
+
+
+SIGNATURE = b'\x89HDF\r\n\x1a\n'
+
+
+def clear_status_flags(filename):
+    """
+    Clears the file consistency flags in the superblock of filename, as
+    h5clear does. HDF5 sets them while a file is open for writing (with
+    version 3 superblocks, i.e. libver='latest'), and refuses to open the
+    file for writing if its writer died.
+
+    Return
+    ------
+    True if the flags were set.
+    """
+    with open(filename, 'r+b') as h5file:
+        offset = 0
+        while True: # THE SUPERBLOCK IS AT 0, 512, 1024, 2048, ...
+            h5file.seek(offset)
+            header = h5file.read(12)
+            if len(header) < 12:
+                raise IOError("{} is not an HDF5 file".format(filename))
+            if header[:8] == SIGNATURE:
+                break
+            offset = max(512, 2*offset)
+
+        version, sizeof_addr = bytearray(header[8:10])
+        flags = bytearray(header[11:12])[0]
+        if version < 2 or flags == 0:
+            return False
+
+        size = 12 + 4*sizeof_addr # WITHOUT THE CHECKSUM
+        h5file.seek(offset)
+        superblock = bytearray(h5file.read(size))
+        superblock[11] = 0
+        h5file.seek(offset)
+        h5file.write(bytes(superblock))
+        h5file.write(struct.pack('<I', lookup3(bytes(superblock))))
+    return True
+
+
+def is_flagged(error):
+    """
+    True if HDF5 refused to open a file because of its consistency flags
+    only, which is the case if its writer died without closing it.
+    """
+    message = str(error)
+    return 'h5clear' in message or 'consistency flags' in message
+
+
+def open_for_recovery(filename):
+    """
+    Opens filename for writing. If HDF5 refuses because the consistency
+    flags of the file are set, they are cleared (see clear_status_flags) and
+    the file is opened again. Any other error, such as the file lock of a
+    writer that is still alive, is raised, so a live file is never touched.
+    """
+    try:
+        return h5py.File(filename, 'a')
+    except (IOError, OSError) as error:
+        if not is_flagged(error):
+            raise
+    clear_status_flags(filename)
+    return h5py.File(filename, 'a')
+
+
+def is_rle(obj):
+    """ True if obj is a group written with put(..., encoding='rle'). """
+    return isinstance(obj, h5py.Group) and obj.attrs.get('encoding') == 'rle'
+
+
+def checkpointed_datasets(h5file):
+    """
+    All datasets and run-length encoded groups in h5file with a VALID_LENGTH
+    attribute.
+    """
+    dsets = list()
+
+    def visit(name, obj):
+        if name.split('/')[0] == METADATA_GROUP:
+            return
+        if (isinstance(obj, h5py.Dataset) or is_rle(obj)) and \
+           VALID_LENGTH in obj.attrs:
+            dsets.append(obj)
+
+    h5file.visititems(visit)
+    return dsets
+
+
+def restore(dset, begin, rows):
+    """
+    Trims dset to its valid length, appends the rows from row begin on that
+    are beyond it, and brings the sidecars of dset up to date.
+
+    Return
+    ------
+    The new length of dset.
+    """
+    length = min(int(dset.attrs[VALID_LENGTH]), dset.shape[0])
+    if begin > length:
+        msg = "The write-ahead log of {} starts at row {}, beyond its valid "\
+              "length {}".format(dset.name, begin, length)
+        raise ValueError(msg)
+    rows = rows[length - begin:]
+    end = length + len(rows)
+    if length == end == dset.shape[0]: # CLEAN, E.G. CLOSED NORMALLY
+        return end
+
+    dset.resize((end,) + dset.shape[1:])
+    if len(rows):
+        dset[length:end, ...] = rows
+    dset.attrs[VALID_LENGTH] = end
+
+    h5file = dset.file
+    for cls in (ChunkStats, ChunkChecksums):
+        path = sidecar_path(cls.kind, dset.name)
+        if path not in h5file:
+            continue
+        sidecar = cls.reopen(h5file[path], dset)
+        first = length // sidecar.chunksize
+        sidecar.nchunks = min(sidecar.nchunks, first)
+        for begin in range(first*sidecar.chunksize, end, sidecar.chunksize):
+            stop = min(begin + sidecar.chunksize, end)
+            sidecar.update(begin, stop, dset[begin:stop, ...])
+        sidecar.flush()
+
+    return end
+
+
+def changed_rows(rows, last=None):
+    """
+    Returns a boolean ndarray that is True for the rows that differ from the
+    row before them, where the first row is compared with last (if any).
+    NaNs are considered equal to each other.
+    """
+    if last is not None:
+        rows = numpy.concatenate((numpy.asarray(last)[numpy.newaxis], rows))
+    if len(rows) == 0:
+        return numpy.zeros(0, bool)
+
+    a, b = rows[1:], rows[:-1]
+    equal = (a == b)
+    if rows.dtype.kind in 'fc':
+        equal |= numpy.isnan(a) & numpy.isnan(b)
+    equal = equal.reshape(len(a), -1).all(axis=1)
+
+    changed = numpy.concatenate(([last is None], ~equal))
+    return changed[1:] if last is not None else changed
+
+
+def restore_runs(group, begin, rows):
+    """
+    Trims the change-log of a run-length encoded group to its valid length,
+    and appends the changes in the rows from row begin on that are beyond
+    it. See restore.
+
+    Return
+    ------
+    The new length of group.
+    """
+    length = int(group.attrs[VALID_LENGTH])
+    if begin > length:
+        msg = "The write-ahead log of {} starts at row {}, beyond its valid "\
+              "length {}".format(group.name, begin, length)
+        raise ValueError(msg)
+    rows = rows[length - begin:]
+    end = length + len(rows)
+
+    index, value = group['index'], group['value']
+    nruns = int(numpy.searchsorted(index[...], length))
+    if nruns == index.shape[0] and end == length == group.attrs['length']:
+        return end # CLEAN, E.G. CLOSED NORMALLY
+
+    last = value[nruns-1] if nruns else None
+    changed = numpy.flatnonzero(changed_rows(rows, last))
+    stop = nruns + len(changed)
+    index.resize((stop,))
+    value.resize((stop,) + value.shape[1:])
+    if len(changed):
+        index[nruns:stop] = changed + length
+        value[nruns:stop, ...] = rows[changed]
+
+    group.attrs['length'] = end
+    group.attrs[VALID_LENGTH] = end
+    return end
+
+
+def recover(filename):
+    """
+    Restores a file whose writer died. Every dataset that was written with
+    checkpoints is trimmed to its valid length, and the rows in its
+    write-ahead log (if any) are appended. The logs are removed afterwards.
+
+    The file is opened before anything is changed, so recover raises an
+    error (and leaves the file and its logs alone) while the writer still
+    holds the file lock. Without file locking (HDF5_USE_FILE_LOCKING=FALSE),
+    HDF5 cannot tell a live writer from a dead one, so only recover files
+    whose writer has exited.
+
+    Parameters
+    ----------
+    filename : str
+        The HDF5 file.
+
+    Return
+    ------
+    A dict {path: number of rows} of the restored datasets.
+    """
+    directory = wal_directory(filename)
+    logs = dict()
+    if os.path.isdir(directory):
+        for name in os.listdir(directory):
+            if name.endswith(WAL_EXTENSION):
+                path = '/' + unquote(name[:-len(WAL_EXTENSION)])
+                logs[path] = os.path.join(directory, name)
+
+    lengths = dict()
+    with open_for_recovery(filename) as h5file:
+        for obj in checkpointed_datasets(h5file):
+            dset = obj['value'] if is_rle(obj) else obj
+            if obj.name in logs:
+                begin, rows = read_log(logs[obj.name], dset)
+            else:
+                begin = 0
+                rows = numpy.empty((0,) + dset.shape[1:], dtype=dset.dtype)
+            if is_rle(obj):
+                lengths[obj.name] = restore_runs(obj, begin, rows)
+            else:
+                lengths[obj.name] = restore(obj, begin, rows)
+
+    if os.path.isdir(directory):
+        shutil.rmtree(directory)
+    return lengths
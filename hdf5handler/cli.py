@@ -0,0 +1,190 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Command line interface:
+
+    $ hdf5handler verify mydata.hdf5
+    $ hdf5handler recover mydata.hdf5
+    $ hdf5handler ls mydata.hdf5
+    $ hdf5handler info mydata.hdf5 [path]
+    $ hdf5handler summary mydata.hdf5 [path] [--workers N] [--memory MiB]
+
+or
+
+    $ python -m hdf5handler verify mydata.hdf5
+
+"""
+
+import argparse
+import h5py
+
+from .verify import verify
+from .checkpoint import recover
+from .summary import walk, describe, summarize, is_rle
+from .sidecars import METADATA_GROUP
+
+
+def cmd_verify(args):
+    report = verify(args.filename, workers=args.workers)
+
+    status = 0
+    for path in sorted(report):
+        corrupted = report[path]
+        if corrupted:
+            status = 1
+            ranges = ', '.join('{}:{}'.format(begin, end)
+                               for begin, end in corrupted)
+            print("{}: CORRUPTED rows {}".format(path, ranges))
+        else:
+            print("{}: OK".format(path))
+
+    if not report:
+        print("No datasets with checksums found.")
+    return status
+
+
+def cmd_recover(args):
+    lengths = recover(args.filename)
+    for path in sorted(lengths):
+        print("{}: {} rows".format(path, lengths[path]))
+
+    if not lengths:
+        print("No checkpointed datasets found.")
+    return 0
+
+
+def format_bytes(nbytes):
+    """ Returns nbytes as a human readable str, e.g. '1.5 MiB'. """
+    for unit in ('B', 'KiB', 'MiB', 'GiB'):
+        if nbytes < 1024:
+            break
+        nbytes /= 1024.0
+    else:
+        unit = 'TiB'
+    if unit == 'B':
+        return '{} B'.format(int(nbytes))
+    return '{:.1f} {}'.format(nbytes, unit)
+
+
+def leaves(h5file, path, metadata=False):
+    """ The (name, obj) of the datasets and run-length encoded groups. """
+    return [(name, obj) for name, obj in walk(h5file, path, metadata)
+            if isinstance(obj, h5py.Dataset) or is_rle(obj)]
+
+
+def cmd_ls(args):
+    with h5py.File(args.filename, 'r') as h5file:
+        for name, obj in walk(h5file, args.path, args.all):
+            if isinstance(obj, h5py.Dataset) or is_rle(obj):
+                info = describe(obj)
+                print("{:<40} {:<8} {:<16} {}".format(
+                    name, info['kind'], str(info['shape']), info['dtype']))
+            else:
+                print("{:<40} group".format(name))
+    return 0
+
+
+def cmd_info(args):
+    with h5py.File(args.filename, 'r') as h5file:
+        for name, obj in leaves(h5file, args.path, args.all):
+            info = describe(obj)
+            print(name)
+            print("    {:<10} {}".format('kind', info['kind']))
+            print("    {:<10} {}".format('shape', info['shape']))
+            if 'length' in info:
+                print("    {:<10} {}".format('length', info['length']))
+            if 'runs' in info:
+                print("    {:<10} {}".format('runs', info['runs']))
+            print("    {:<10} {}".format('dtype', info['dtype']))
+            print("    {:<10} {}".format(
+                'layout', 'chunked {}'.format(info['chunks'])
+                if info['chunks'] else 'contiguous'))
+            print("    {:<10} {}".format(
+                'filters', ', '.join(info['filters']) or '-'))
+            ratio = '{:.2f}'.format(info['ratio']) if info['ratio'] else '-'
+            print("    {:<10} {} ({} uncompressed, ratio {})".format(
+                'storage', format_bytes(info['storage']),
+                format_bytes(info['nbytes']), ratio))
+            print("    {:<10} {}".format(
+                'sidecars', ', '.join(info['sidecars']) or '-'))
+    return 0
+
+
+def cmd_summary(args):
+    with h5py.File(args.filename, 'r') as h5file:
+        names = [name for name, obj in leaves(h5file, args.path, args.all)]
+
+    def fmt(value):
+        return '-' if value is None else '{:.6g}'.format(value)
+
+    print("{:<40} {:>12} {:>8} {:>12} {:>12} {:>12}".format(
+        'path', 'count', 'nan', 'min', 'max', 'mean'))
+    for name in names:
+        stats = summarize(args.filename, name, workers=args.workers,
+                          maxbytes=int(args.memory * 2**20))
+        if stats is None:
+            print("{:<40} {:>12}".format(name, 'not numeric'))
+            continue
+        print("{:<40} {:>12} {:>8} {:>12} {:>12} {:>12}".format(
+            name, stats['count'], stats['nancount'], fmt(stats['min']),
+            fmt(stats['max']), fmt(stats['mean'])))
+    return 0
+
+
+def get_parser():
+    parser = argparse.ArgumentParser(
+        prog='hdf5handler',
+        description="Tools for files written with the HDF5Handler.")
+    subparsers = parser.add_subparsers(dest='command')
+
+    verify_parser = subparsers.add_parser(
+        'verify', help="verify per-chunk checksums and fletcher32 filters")
+    verify_parser.add_argument('filename', help="the HDF5 file")
+    verify_parser.add_argument('-w', '--workers', type=int, default=None,
+                               help="number of processes (default: one per "
+                                    "CPU)")
+    verify_parser.set_defaults(func=cmd_verify)
+
+    recover_parser = subparsers.add_parser(
+        'recover', help="restore a file whose writer died, from its "
+                        "checkpoints and write-ahead logs")
+    recover_parser.add_argument('filename', help="the HDF5 file")
+    recover_parser.set_defaults(func=cmd_recover)
+
+    ls_parser = subparsers.add_parser(
+        'ls', help="list groups and datasets")
+    info_parser = subparsers.add_parser(
+        'info', help="show shape, dtype, chunking, filters and storage")
+    summary_parser = subparsers.add_parser(
+        'summary', help="compute count, NaNs, min, max and mean by streaming "
+                        "over the chunks")
+
+    for subparser in (ls_parser, info_parser, summary_parser):
+        subparser.add_argument('filename', help="the HDF5 file")
+        subparser.add_argument('path', nargs='?', default='/',
+                               help="group or dataset (default: /)")
+        subparser.add_argument('-a', '--all', action='store_true',
+                               help="include the {} metadata group"
+                                    .format(METADATA_GROUP))
+
+    summary_parser.add_argument('-w', '--workers', type=int, default=1,
+                                help="number of processes (default: 1)")
+    summary_parser.add_argument('-m', '--memory', type=float, default=16,
+                                help="MiB of data in memory per process "
+                                     "(default: 16)")
+
+    ls_parser.set_defaults(func=cmd_ls)
+    info_parser.set_defaults(func=cmd_info)
+    summary_parser.set_defaults(func=cmd_summary)
+
+    return parser
+
+
+def main(argv=None):
+    parser = get_parser()
+    args = parser.parse_args(argv)
+
+    if not hasattr(args, 'func'):
+        parser.print_help()
+        return 2
+    return args.func(args)
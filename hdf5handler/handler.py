@@ -4,9 +4,24 @@
 TODO: Write this missing docstring
 """
 
+import os
+import math
+import shutil
+import threading
+import contextlib
 import h5py
 import numpy
 
+try:
+    from h5py._objects import phil
+except ImportError:
+    phil = threading.RLock()
+
+from .sidecars import ChunkStats, ChunkChecksums
+from .rawfile import RawFile
+from .reader import Runs
+from .checkpoint import WriteAheadLog, wal_directory, VALID_LENGTH
+
 class HDF5Handler(object):
     """
     The idea is that the HDF5Handler mimics the behaviour of 'open' used as a
@@ -70,7 +85,11 @@ class HDF5Handler(object):
 
     """
 
-    def __init__(self, filename, mode='w', prefix=None):
+    def __init__(self, filename, mode='w', prefix=None, in_memory=False,
+                 max_memory=None, backend='hdf5', threadsafe=False,
+                 fs_strategy=None, fs_page_size=2**16, page_buf_size=None,
+                 meta_block_size=None, finalize=None, finalize_limit=2**30,
+                 checkpoint=None, wal=False):
         """
         Parameters
         ----------
@@ -84,35 +103,288 @@ class HDF5Handler(object):
         prefix : str
            #TODO explain prefix, and show typical use case.
 
+        in_memory : bool
+           Build the whole file in memory with h5py's 'core' driver, and
+           write it to filename in one go when the handler is closed. This
+           avoids many small writes, which is worthwhile on network
+           filesystems and for short jobs.
+
+        max_memory : int
+           Only used if in_memory is True. Once more than max_memory bytes of
+           data have been written to the datasets, the file is written to
+           filename and the handler continues on disk.
+
+        backend : str
+           'hdf5' writes an HDF5 file with h5py. 'raw' writes a directory of
+           append-only raw binary files with JSON headers instead, which can
+           be read with numpy.memmap and converted to HDF5 afterwards. See
+           hdf5handler.rawfile. Filters (e.g. quantize) and in_memory are not
+           supported by the raw backend.
+
+        threadsafe : bool
+           Allow put to be called from several threads at once. Every dataset
+           then has its own lock, so threads that put to different paths do
+           not wait for each other. Creating datasets, flushing and spilling
+           happen under the handler's lock (and h5py's global lock).
+           Note that this makes concurrent puts safe, not faster: h5py
+           serializes all HDF5 calls with its global lock, and the rest of a
+           put holds the GIL, so the put rate does not grow with the number
+           of threads (see hdf5handler.benchmarks.benchmark_threads).
+
+        fs_strategy : str
+           HDF5 file space strategy of a new file: 'page', 'fsm', 'aggregate'
+           or 'none', or None for the HDF5 default. With 'page', raw data and
+           metadata are allocated in separate pages of fs_page_size bytes,
+           which keeps the metadata of many datasets together. Small files
+           grow to at least a few pages, and the gain in put and read rates
+           is small (see hdf5handler.benchmarks.benchmark_file_space).
+           fs_strategy, page_buf_size and meta_block_size require a recent
+           version of h5py.
+
+        fs_page_size : int
+           Page size in bytes, if fs_strategy is 'page'.
+
+        page_buf_size : int
+           Size in bytes of HDF5's page buffer, which caches whole pages of
+           paged files, e.g. 2**22. Must be a multiple of fs_page_size. None
+           disables it.
+
+        meta_block_size : int
+           Minimum size in bytes of the blocks in which metadata is
+           allocated. None for the HDF5 default (2048).
+
+        finalize : str
+           'contiguous' rewrites the datasets with contiguous storage when the
+           handler is closed, so that readers can access them without chunk
+           lookups, e.g. with hdf5handler.reader.memmap. The file is copied
+           to a new file, which then replaces it, so closing needs room for a
+           second copy. See HDF5Handler._make_contiguous.
+
+        finalize_limit : int
+           Datasets larger than finalize_limit bytes are not finalized.
+
+        checkpoint : int
+           Every checkpoint chunks written to a dataset, record its number of
+           valid rows in its 'valid_length' attribute and flush the file, so
+           that the file can be restored with hdf5handler.checkpoint.recover
+           if the process dies. None disables checkpoints. Run-length encoded
+           datasets write their buffered changes at every checkpoint, which
+           is due every checkpoint*chunksize puts. Not supported with
+           in_memory, because every checkpoint writes the whole file.
+
+        wal : bool
+           Also log the rows put since the last checkpoint of a dataset in a
+           write-ahead log, which recover appends to the restored dataset.
+           The logs are kept in the directory <filename>.wal, which is
+           removed when the handler is closed. Requires checkpoint. Datasets
+           with dtype='auto' are not logged.
+
         """
+        if backend not in ('hdf5', 'raw'):
+            raise ValueError("Unknown backend: {}".format(backend))
+        if backend == 'raw' and in_memory:
+            raise ValueError("The raw backend does not support in_memory")
+        if finalize not in (None, 'contiguous'):
+            raise ValueError("Unknown finalize: {}".format(finalize))
+        if checkpoint is not None and backend == 'raw':
+            raise ValueError("The raw backend does not support checkpoint")
+        if checkpoint is not None and in_memory:
+            raise ValueError("in_memory does not support checkpoint")
+        if wal and not checkpoint:
+            raise ValueError("wal requires checkpoint")
+
         self.filename = filename
         self.mode = mode
         self.prefix = prefix
+        self.in_memory = in_memory
+        self.max_memory = max_memory
+        self.backend = backend
+        self.threadsafe = threadsafe
+        self.fs_strategy = fs_strategy
+        self.fs_page_size = fs_page_size
+        self.page_buf_size = page_buf_size
+        self.meta_block_size = meta_block_size
+        self.finalize = finalize
+        self.finalize_limit = finalize_limit
+        self.checkpoint = checkpoint
+        self.wal = wal
+        self.lock = threading.RLock()
 
         self.index = dict()
         self.index_converters = dict()
+        self.memory_used = 0
 
 
     def __enter__(self):
-        # According to h5py docs, libver='latest' is specified for potential
-        # performance advantages procured by maximum file structure
-        # sophistication. (Could also mean losing some backwards compatibility)
-        self.file = h5py.File(self.filename, self.mode, libver='latest')
+        self.open()
         return self
 
     def __exit__(self, extype, exvalue, traceback):
-        self.flushbuffers()
-        self.file.close()
+        self.close()
         return False
 
-    #TODO; how to avoid code replication here?
     def open(self):
-        self.file = h5py.File(self.filename, self.mode, libver='latest')
+        if self.backend == 'raw':
+            self.file = RawFile(self.filename, self.mode)
+        else:
+            self.file = self.open_h5file(self.mode, self.in_memory)
+
+        # The logs of a previous file of the same name are meaningless now.
+        if self.checkpoint and self.mode in ('w', 'w-', 'x'):
+            if os.path.isdir(wal_directory(self.filename)):
+                shutil.rmtree(wal_directory(self.filename))
+
+    def open_h5file(self, mode, in_memory, filename=None):
+        """
+        Opens filename (by default the filename of the handler) with h5py,
+        using the file creation and access properties given to the
+        HDF5Handler.
+        """
+        if filename is None:
+            filename = self.filename
+
+        # According to h5py docs, libver='latest' is specified for potential
+        # performance advantages procured by maximum file structure
+        # sophistication. (Could also mean losing some backwards compatibility)
+        kwargs = dict(libver='latest')
+
+        if in_memory:
+            kwargs.update(driver='core', backing_store=True)
+
+        if self.meta_block_size is not None:
+            kwargs.update(meta_block_size=self.meta_block_size)
+
+        creating = mode in ('w', 'w-', 'x') or not os.path.exists(filename)
+        if creating and self.fs_strategy is not None:
+            kwargs.update(fs_strategy=self.fs_strategy)
+            if self.fs_strategy == 'page':
+                kwargs.update(fs_page_size=self.fs_page_size)
+
+        if self.page_buf_size is not None and \
+           (not creating or self.fs_strategy == 'page'):
+            try:
+                return self.open_h5py_file(filename, mode,
+                                           page_buf_size=self.page_buf_size,
+                                           **kwargs)
+            except (OSError, ValueError):
+                if creating:
+                    raise
+                # An existing file that is not paged has no page buffer.
+
+        return self.open_h5py_file(filename, mode, **kwargs)
+
+    def open_h5py_file(self, filename, mode, **kwargs):
+        """
+        h5py.File(filename, mode, **kwargs), with a clear error if the file
+        space options are not supported by the installed h5py.
+        """
+        try:
+            return h5py.File(filename, mode, **kwargs)
+        except TypeError:
+            options = set(kwargs) & set(('fs_strategy', 'fs_page_size',
+                                         'page_buf_size', 'meta_block_size'))
+            if not options:
+                raise
+            msg = "h5py {} does not support {}".format(
+                h5py.version.version, ', '.join(sorted(options)))
+            raise ValueError(msg)
 
-    #TODO; how to avoid code replication here?
     def close(self):
         self.flushbuffers()
         self.file.close()
+        # Raw datasets are contiguous already.
+        if self.finalize == 'contiguous' and self.backend == 'hdf5':
+            self._make_contiguous(self.finalize_limit)
+
+        if self.wal:
+            for dataset in self.index.values():
+                if dataset.wal is not None:
+                    dataset.wal.close()
+            if os.path.isdir(wal_directory(self.filename)):
+                shutil.rmtree(wal_directory(self.filename))
+
+    def _make_contiguous(self, limit=None, copysize=2**24):
+        """
+        Rewrites the file, with contiguous instead of chunked storage for
+        the datasets. Datasets that are filtered (e.g. quantized), run-length
+        encoded or larger than limit bytes are copied as they are. Only
+        called by close, after the file is closed, since contiguous datasets
+        cannot be resized (or flushed) anymore.
+
+        Everything is copied to a new file, which then replaces filename, so
+        the space of the chunked datasets is not kept. If the process dies
+        before, filename is left as it was.
+
+        Parameters
+        ----------
+        limit : int
+            Maximum size in bytes of a dataset to rewrite. None means no
+            limit.
+
+        copysize : int
+            Data is copied in blocks of at most copysize bytes (or one row).
+        """
+        names = set()
+        with h5py.File(self.filename, 'r') as h5file:
+            for dataset in self.index.values():
+                if not isinstance(dataset, Dataset):
+                    continue
+                dset = h5file[dataset.name]
+                if dset.chunks is None or is_filtered(dset):
+                    continue
+                if limit is None or dset.nbytes <= limit:
+                    names.add(dset.name)
+
+            if not names:
+                return
+
+            tmpname = self.filename + '.contiguous~'
+            new = self.open_h5file('w', in_memory=False, filename=tmpname)
+            try:
+                copy_group(h5file, new, names, copysize)
+            finally:
+                new.close()
+
+        os.rename(tmpname, self.filename)
+
+    @contextlib.contextmanager
+    def exclusive(self):
+        """
+        Context manager that holds the handler's lock, in threadsafe mode the
+        locks of all datasets, and h5py's lock.
+
+        The locks are always taken in this order: a thread in put holds the
+        lock of its dataset while h5py takes its lock, so waiting for a
+        dataset lock while holding h5py's lock would deadlock.
+        """
+        with self.lock:
+            locks = list()
+            if self.threadsafe:
+                locks = [dataset.lock for dataset in self.index.values()]
+            for lock in locks:
+                lock.acquire()
+            try:
+                with phil:
+                    yield
+            finally:
+                for lock in locks:
+                    lock.release()
+
+    def spill(self):
+        """
+        Writes an in-memory file to disk and continues with the file on disk.
+        Data that is still buffered stays in the buffers.
+        """
+        with self.exclusive():
+            if not self.in_memory: # Another thread was first
+                return
+
+            self.file.close()
+            self.in_memory = False
+            self.file = self.open_h5file('a', in_memory=False)
+
+            for dataset in self.index.values():
+                dataset.rebind(self.file)
 
     def put(self, data, dset_path, **kwargs):
         """
@@ -152,6 +424,15 @@ class HDF5Handler(object):
         dtype
         chunksize
         blockfactor
+        stats
+        nancount
+        quantize
+        encoding
+        chunks
+        checksum
+        fletcher32
+
+        See HDF5Handler.create_dset.__doc__
         """
 
         if self.prefix:
@@ -161,15 +442,188 @@ class HDF5Handler(object):
 
         try:
             converter = self.index_converters[fulldsetpath]
-            ndarray = converter(data)
-            self.index[fulldsetpath].append_to_dbuffer(ndarray)
         except KeyError:
-            self.create_dset(data, fulldsetpath, **kwargs)
-            self.put(data, dset_path, **kwargs)
+            with self.lock:
+                with phil:
+                    if fulldsetpath not in self.index_converters:
+                        self.create_dset(data, fulldsetpath, **kwargs)
+            converter = self.index_converters[fulldsetpath]
+
+        ndarray = converter(data)
+        dataset = self.index[fulldsetpath]
+
+        if self.threadsafe:
+            with dataset.lock:
+                dataset.append_to_dbuffer(ndarray)
+                if self.checkpoint:
+                    self.save_state(dataset, [ndarray])
+        else:
+            dataset.append_to_dbuffer(ndarray)
+            if self.checkpoint:
+                self.save_state(dataset, [ndarray])
+
+        if self.in_memory and self.max_memory is not None:
+            self.check_memory(dataset)
+
+
+    def check_memory(self, dataset):
+        """
+        Spills an in-memory file to disk once the data written to its
+        datasets exceeds max_memory bytes. HDF5 only updates the size of a
+        file in memory when it is flushed, so the bytes written by every
+        dataset are counted instead (see Dataset.nbytes).
+        """
+        with self.lock:
+            self.memory_used += dataset.nbytes - dataset.nbytes_counted
+            dataset.nbytes_counted = dataset.nbytes
+            full = self.memory_used > self.max_memory
+
+        if full:
+            self.spill()
+
+    def get(self, dset_path, key=Ellipsis):
+        """
+        Reads rows that were put to dset_path, including the ones that are
+        still buffered, without flushing:
+
+        >>> handler.get('temperature', slice(-100, None))
+        >>> handler.get('temperature', -1)
+
+        Only rows that were actually put are read, never the preallocated
+        part of a block.
+
+        Parameters
+        ----------
+        dset_path : str
+            unix-style path, as given to put.
+
+        key : int, slice or Ellipsis
+            Selection of rows.
+        """
+        if self.prefix:
+            dset_path = self.prefix+dset_path
+
+        dataset = self.index[dset_path]
+        if self.threadsafe:
+            with dataset.lock:
+                return dataset[key]
+        return dataset[key]
+
+    def tail(self, dset_path, n):
+        """
+        Returns the last n rows that were put to dset_path (or all of them,
+        if there are fewer than n). See HDF5Handler.get.
+        """
+        if self.prefix:
+            dset_path = self.prefix+dset_path
+
+        dataset = self.index[dset_path]
+        if self.threadsafe:
+            with dataset.lock:
+                return dataset[max(0, len(dataset) - n):]
+        return dataset[max(0, len(dataset) - n):]
+
+    def put_table(self, table, group, **kwargs):
+        """
+        Puts a table of rows: every column is appended to the dataset
+        group/<column name>, as if put had been called for every value, but
+        with whole chunks written at once.
 
+        >>> handler.put_table({'energy': energies, 'time': times}, 'events')
+
+        The columns of a group are kept in lockstep, i.e. they always have
+        the same number of rows and are therefore written, resized and
+        flushed together.
+
+        Parameters
+        ----------
+        table : dict of array_like, or a pandas.DataFrame
+            Columns of equal length. Every row of a column must be valid data,
+            see HDF5Handler.put.__doc__, with the shape of the rows of its
+            dataset, if it exists already.
+
+        group : str
+            unix-style path of the group of the columns.
+
+        Valid keyword arguments are the same as for HDF5Handler.put and are
+        used to create the datasets of new columns.
+        """
+        columns = [(str(name), numpy.asarray(column))
+                   for name, column in table.items()]
+
+        lengths = set(len(column) for name, column in columns)
+        if len(lengths) > 1:
+            raise ValueError("Columns have unequal lengths: {}".format(lengths))
+
+        if self.prefix:
+            group = self.prefix+group
+
+        with self.lock:
+            # Check every column first, so that an error leaves all datasets
+            # of the group untouched.
+            for name, column in columns:
+                path = group.rstrip('/') + '/' + name
+                if path in self.index and \
+                   column.shape[1:] != tuple(self.index[path].arr_shape):
+                    msg = "Rows of column {} have shape {}, but the rows of "\
+                          "{} have shape {}".format(
+                              name, column.shape[1:], path,
+                              tuple(self.index[path].arr_shape))
+                    raise ValueError(msg)
+
+            datasets = list()
+            for name, column in columns:
+                path = group.rstrip('/') + '/' + name
+                if path not in self.index:
+                    sample = numpy.zeros(column.shape[1:], dtype=column.dtype)
+                    with phil:
+                        self.create_dset(sample, path, **kwargs)
+                datasets.append((path, self.index[path]))
+
+            nrows = set(len(dataset) for path, dataset in datasets)
+            if len(nrows) > 1:
+                msg = "Columns of {} are out of step: {}".format(
+                    group,
+                    dict((path, len(dataset)) for path, dataset in datasets))
+                raise AssertionError(msg)
+
+            for (name, column), (path, dataset) in zip(columns, datasets):
+                with dataset.lock:
+                    dataset.extend(column)
+                    if self.checkpoint:
+                        self.save_state(dataset, column)
+
+        if self.in_memory and self.max_memory is not None:
+            for path, dataset in datasets:
+                self.check_memory(dataset)
+
+    def save_state(self, dataset, rows):
+        """
+        Called after rows were put to dataset, if checkpoints are enabled.
+        Checkpoints the dataset if it is due, otherwise logs rows in its
+        write-ahead log (if any). The log thus holds the rows put since the
+        last checkpoint.
+        """
+        if isinstance(dataset, RunLengthDataset):
+            # The checkpoint writes the buffered changes.
+            valid, pending = len(dataset), ()
+        else:
+            valid, pending = dataset.written, dataset.dbuffer
+
+        if valid - dataset.checkpointed >= self.checkpoint*dataset.chunksize:
+            # The log is reset after the flush: if the process dies in
+            # between, recover skips the rows that it logged before.
+            dataset.save_checkpoint(valid)
+            self.file.flush()
+            if dataset.wal is not None:
+                dataset.wal.reset(valid, pending)
+        elif dataset.wal is not None:
+            dataset.wal.write(rows)
 
     def create_dset(self, data, dset_path, chunksize=1000, blockfactor=100,
-                    dtype='float64'):
+                    dtype='float64', stats=False, nancount=False,
+                    quantize=None, encoding=None, chunks='append',
+                    checksum=None, fletcher32=False):
         """
         Define h5py dataset parameters here.
 
@@ -209,22 +663,136 @@ class HDF5Handler(object):
             float32
             etc.
 
+            or 'auto', in which case the narrowest dtype that can hold the
+            first chunk without loss is used (e.g. uint8 for a counter that
+            stays below 256). If a later chunk does not fit, the dataset is
+            rewritten once with the 64-bit dtype of the required kind
+            (int64, uint64 or float64). See AdaptiveDataset.
+
+        stats : bool
+            Record the min, max and number of rows of every chunk in a sidecar
+            dataset, so that readers can skip chunks that cannot match a value
+            predicate. See hdf5handler.reader.iter_chunks.
+
+        nancount : bool
+            Also record the number of NaNs of every chunk. Only used if stats
+            is True.
+
+        quantize : float
+            Lossy compression with an absolute tolerance: every value is
+            stored such that abs(stored - value) <= quantize, using HDF5's
+            scale-offset filter. Requires a floating point dtype.
+
+        encoding : str
+            'rle' stores a change-log of (start_index, value) pairs instead of
+            a row per put, which is much smaller for values that change only
+            now and then, such as configuration flags and setpoints. The
+            dset_path then becomes an h5py Group with the datasets 'index'
+            and 'value'. Read it with hdf5handler.reader.RunLengthReader.
+            Cannot be combined with stats, quantize, checksum, fletcher32
+            or dtype='auto'.
+
+        chunks : str or tuple
+            The HDF5 chunk shape, or one of the following policies, which
+            only differ for multi-dimensional records. The buffer always holds
+            chunksize records and is written as one slab, whatever the chunk
+            shape.
+
+            'append'  (chunksize,) + record shape. Every chunk holds complete
+                      records, which gives the highest append throughput.
+            'record'  (1,) + record shape. Reading a single record reads
+                      exactly one chunk.
+            'roi'     The records are tiled in all dimensions, into chunks of
+                      about 1 MiB, e.g. (16, 64, 64) for float32 images.
+                      Reading a region of interest over time then only reads
+                      the tiles that overlap the region.
+
+            The first dimension of a tuple must divide chunksize.
+            See get_chunkshape.
+
+        checksum : str
+            Record a digest of every chunk in a sidecar dataset, computed
+            from the chunk in memory: 'crc32', 'adler32' or any algorithm of
+            hashlib (e.g. 'sha1'). True means 'crc32'. The file can then be
+            checked with 'hdf5handler verify' (see hdf5handler.verify).
+
+        fletcher32 : bool
+            Enable HDF5's fletcher32 checksum filter, which HDF5 checks on
+            every read.
+
         """
         arr_shape = get_shape(data)
         converter = get_ndarray_converter(data)
 
+        if encoding == 'rle':
+            if stats or quantize is not None or dtype == 'auto' or \
+               checksum or fletcher32:
+                msg = "encoding='rle' does not support stats, quantize, "\
+                      "checksum, fletcher32 or dtype='auto'"
+                raise ValueError(msg)
+            group = self.file.create_group(dset_path)
+            dataset = RunLengthDataset(group, arr_shape, chunksize, dtype)
+            if self.checkpoint:
+                self.start_checkpoints(dataset, dataset.value.dtype)
+            self.index.update({dset_path: dataset})
+            self.index_converters.update({dset_path: converter})
+            return
+        elif encoding is not None:
+            raise ValueError("Unknown encoding: {}".format(encoding))
+
         blocksize = blockfactor * chunksize
 
-        chunkshape = sum(((chunksize,), arr_shape), ())
         maxshape = sum(((None,), arr_shape), ())
 
+        adaptive = (dtype == 'auto')
+        if adaptive:
+            # Placeholder, the dtype is chosen when the first chunk is written.
+            dtype = numpy.array(data).dtype
+
+        chunkshape = get_chunkshape(chunks, chunksize, arr_shape, dtype)
+
         dsetkw = dict(chunks=chunkshape, maxshape=maxshape, dtype=dtype)
+
+        if quantize is not None:
+            if adaptive or numpy.dtype(dtype).kind != 'f':
+                raise ValueError("quantize requires a floating point dtype")
+            dsetkw.update(scaleoffset=get_scaleoffset(quantize))
+
+        if fletcher32:
+            dsetkw.update(fletcher32=True)
+
         init_shape = sum(((blocksize,), arr_shape), ())
         dset = self.file.create_dataset(dset_path, shape=init_shape, **dsetkw)
 
-        self.index.update({dset_path: Dataset(dset)})
+        sidecars = list()
+        if stats:
+            sidecars.append(ChunkStats(dset, chunksize, blockfactor, nancount))
+        if checksum:
+            algorithm = 'crc32' if checksum is True else checksum
+            sidecars.append(ChunkChecksums(dset, chunksize, blockfactor,
+                                           algorithm))
+
+        if adaptive:
+            dataset = AdaptiveDataset(dset, sidecars, chunksize)
+        else:
+            dataset = Dataset(dset, sidecars, chunksize)
+
+        if self.checkpoint:
+            self.start_checkpoints(dataset, None if adaptive else dset.dtype)
+
+        self.index.update({dset_path: dataset})
         self.index_converters.update({dset_path: converter})
 
+    def start_checkpoints(self, dataset, dtype):
+        """
+        Records the first checkpoint of a new dataset and, with wal=True,
+        opens its write-ahead log of rows of dtype (None for no log).
+        """
+        if self.wal and dtype is not None:
+            dataset.wal = WriteAheadLog(self.filename, dataset.name, dtype)
+        dataset.save_checkpoint(0)
+        self.file.flush() # THE DATASET EXISTS ON DISK FROM NOW ON
+
     def flushbuffers(self):
         """
         When the number of handler.put calls is not a multiple of buffersize,
@@ -232,8 +800,17 @@ class HDF5Handler(object):
         written when it is full. Call this method to write unwritten arrays in
         all of the dbuffers.
         """
-        for dset in self.index.values():
-            dset.flush()
+        with self.exclusive():
+            for dset in self.index.values():
+                dset.flush()
+
+            if self.checkpoint:
+                for dataset in self.index.values():
+                    dataset.save_checkpoint(len(dataset))
+                self.file.flush()
+                for dataset in self.index.values():
+                    if dataset.wal is not None:
+                        dataset.wal.reset(len(dataset))
 
     #TODO: a method to easily add a comment to the attrs of a dataset.
     def add_comment(self):
@@ -253,21 +830,109 @@ class HDF5Handler(object):
 
 class Dataset(object):
     """ TODO: write docstring"""
-    def __init__(self, dset):
+    def __init__(self, dset, sidecars=(), chunksize=None):
         """
         Parameters
         ----------
         dset: h5py Dataset
 
+        sidecars: list of sidecars (see hdf5handler.sidecars) that are updated
+            with every chunk written to dset.
+
+        chunksize: number of rows in the dbuffer, i.e. the number of rows that
+            is written at once. It must be a multiple of the first dimension
+            of the chunks of dset, which is the default.
+
         """
         self.dset = dset
+        self.name = dset.name
         self.chunkcounter = 0
         self.blockcounter = 0
-        self.chunksize = dset.chunks[0]
+        self.chunksize = chunksize or dset.chunks[0]
         self.blocksize = dset.shape[0]
         self.arr_shape = dset.shape[1:]
+        self.sidecars = list(sidecars)
+        self.trimmed = False
+        self.checkpointed = 0
+        self.wal = None
+        self.nbytes = 0 # WRITTEN TO dset, SEE HDF5Handler.check_memory
+        self.nbytes_counted = 0
 
         self.dbuffer = list()
+        self.lock = threading.Lock()
+
+    def rebind(self, h5file):
+        """
+        Continue with the dataset of the same name in (the reopened) h5file.
+        """
+        self.dset = h5file[self.name]
+        for sidecar in self.sidecars:
+            sidecar.rebind(h5file)
+
+    @property
+    def written(self):
+        """ The number of rows written to dset. """
+        return self.blockcounter*self.blocksize + \
+               self.chunkcounter*self.chunksize
+
+    @property
+    def blockend(self):
+        """ The end of the current block. """
+        return (self.blockcounter + 1)*self.blocksize
+
+    def save_checkpoint(self, length):
+        """
+        Records that the first length rows of dset are valid. See
+        hdf5handler.checkpoint.
+        """
+        self.dset.attrs[VALID_LENGTH] = length
+        self.checkpointed = length
+
+    def retype(self, dtype):
+        """
+        Rewrites dset (and its sidecars) with a different dtype.
+        """
+        self.dset = rewrite_dataset(self.dset, self.written, self.blocksize,
+                                    dtype=dtype)
+        for sidecar in self.sidecars:
+            sidecar.retype(self.dset)
+
+    def write(self, begin, end, ndarray):
+        """
+        Writes ndarray to dset[begin:end] and updates the sidecars, once for
+        every chunk in ndarray.
+        """
+        if end > begin:
+            self.dset[begin:end, ...] = ndarray
+            self.nbytes += (end - begin) * self.dset.dtype.itemsize * \
+                           int(numpy.prod(self.arr_shape))
+            for sidecar in self.sidecars:
+                for chunk in range(begin, end, self.chunksize):
+                    stop = min(chunk + self.chunksize, end)
+                    sidecar.update(chunk, stop, ndarray[chunk-begin:stop-begin])
+
+    def write_chunks(self, ndarray):
+        """
+        Writes ndarray, whose length is a multiple of chunksize, at the end of
+        the written rows. ndarray may not extend beyond the current block.
+        """
+        begin = self.written
+        end = begin + len(ndarray)
+
+        if self.trimmed: # UNDO THE TRIM OF THE LAST FLUSH
+            new_shape = sum(((self.blockend,), self.arr_shape), ())
+            self.dset.resize(new_shape)
+            self.trimmed = False
+
+        self.write(begin, end, ndarray)
+
+        if end == self.blockend: #BLOCK IS FULL --> CREATE NEW BLOCK
+            new_shape = sum(((end+self.blocksize,), self.arr_shape), ())
+            self.dset.resize(new_shape)
+            self.blockcounter += 1
+            self.chunkcounter = 0
+        else:
+            self.chunkcounter += len(ndarray) // self.chunksize
 
     def append_to_dbuffer(self, array):
         """
@@ -279,42 +944,504 @@ class Dataset(object):
         self.dbuffer.append(array)
 
         if len(self.dbuffer) == self.chunksize: # THEN WRITE AND CLEAR BUFFER
-            begin = self.blockcounter*self.blocksize + \
-                    self.chunkcounter*self.chunksize
-            end = begin + self.chunksize
-            dbuffer_ndarray = numpy.array(self.dbuffer)
-            self.dset[begin:end, ...] = dbuffer_ndarray # WRITES BUFFER
-            self.dbuffer = list()                       # CLEARS BUFFER
-
-            if end == self.dset.shape[0]: #BLOCK IS FULL --> CREATE NEW BLOCK
-                new_shape = sum(((end+self.blocksize,), self.arr_shape), ())
-                self.dset.resize(new_shape)
-                self.blockcounter += 1
-                self.chunkcounter = 0
-            else:
-                self.chunkcounter += 1
+            self.write_chunks(numpy.array(self.dbuffer))
+            self.dbuffer = list()
         else:
             pass #wait till dbuffer is 'full'
 
+    def extend(self, ndarray):
+        """
+        Appends all rows of ndarray. The dbuffer is completed first, then all
+        whole chunks are written directly in slabs of up to a block, and the
+        remaining rows are buffered.
+
+        Parameters
+        ----------
+        ndarray: ndarray of shape (nrows,) + arr_shape
+
+        """
+        nrows = len(ndarray)
+        i = 0
+
+        if self.dbuffer:
+            i = min(self.chunksize - len(self.dbuffer), nrows)
+            self.dbuffer.extend(ndarray[:i])
+            if len(self.dbuffer) == self.chunksize:
+                self.write_chunks(numpy.array(self.dbuffer))
+                self.dbuffer = list()
+
+        while nrows - i >= self.chunksize:
+            room = self.blockend - self.written
+            nchunks = min((nrows - i) // self.chunksize,
+                          room // self.chunksize)
+            end = i + nchunks*self.chunksize
+            self.write_chunks(ndarray[i:end])
+            i = end
+
+        self.dbuffer.extend(ndarray[i:])
+
+    def __len__(self):
+        """ The number of rows, including the ones that are buffered. """
+        return self.written + len(self.dbuffer)
+
+    def __getitem__(self, key):
+        """
+        Reads rows from the written part of dset and from the dbuffer.
+
+        Parameters
+        ----------
+        key : int, slice or Ellipsis
+        """
+        if key is Ellipsis:
+            key = slice(None)
+
+        if not isinstance(key, slice):
+            i = int(key)
+            if i < 0:
+                i += len(self)
+            if not 0 <= i < len(self):
+                raise IndexError("index {} is out of range".format(key))
+            return self[i:i+1][0]
+
+        start, stop, step = key.indices(len(self))
+        if step < 0:
+            return self[stop+1:start+1][::step]
+        stop = max(start, stop)
+
+        written = self.written
+        parts = list()
+        if start < written:
+            parts.append(self.dset[start:min(stop, written), ...])
+        if stop > written:
+            buffered = self.dbuffer[max(start, written)-written:stop-written]
+            parts.append(self.buffered_ndarray(buffered))
+
+        if not parts:
+            shape = sum(((0,), self.arr_shape), ())
+            return numpy.empty(shape, dtype=self.dset.dtype)
+        return numpy.concatenate(parts)[::step]
+
+    def buffered_ndarray(self, rows):
+        """
+        Returns rows of the dbuffer as an ndarray, in the dtype of dset.
+        """
+        shape = sum(((len(rows),), self.arr_shape), ())
+        return numpy.array(rows, dtype=self.dset.dtype).reshape(shape)
+
     def flush(self, trim=True):
         """
         Flushes the dbuffer, i.e. writes arrays in the dbuffer and resizes the
         dataset.
+
+        The arrays are kept in the dbuffer, because they do not make up a
+        whole chunk: they are written again (in place) by the next flush or
+        as part of the next chunk. Hence it is safe to flush more than once,
+        and to put after a flush.
         """
         dbuffer = self.dbuffer
 
         dbuffer_ndarray = numpy.array(dbuffer)
 
-        begin = self.blockcounter*self.blocksize +\
-                self.chunkcounter*self.chunksize
-
+        begin = self.written
         end = begin + len(dbuffer)
-        self.dset[begin:end, ...] = dbuffer_ndarray
-        self.dbuffer = list()
+        self.write(begin, end, dbuffer_ndarray)
 
         if trim:
             new_shape = sum(((end,), self.arr_shape), ())
             self.dset.resize(new_shape)
+            self.trimmed = True
+            for sidecar in self.sidecars:
+                sidecar.flush()
+
+
+class AdaptiveDataset(Dataset):
+    """
+    A Dataset whose dtype is the narrowest dtype that holds the first chunk
+    without loss. If a later chunk does not fit, the dataset is widened to
+    the 64-bit dtype of the required kind, so it is rewritten at most once
+    per kind (e.g. uint8 -> int64 -> float64).
+    """
+    def __init__(self, dset, sidecars=(), chunksize=None):
+        Dataset.__init__(self, dset, sidecars, chunksize)
+        self.narrowed = False
+
+    def write(self, begin, end, ndarray):
+        if end > begin:
+            narrowest = get_narrowest_dtype(ndarray)
+            current = self.dset.dtype
+
+            if not self.narrowed:
+                self.narrowed = True
+                if narrowest != current:
+                    self.retype(narrowest)
+
+            elif numpy.promote_types(current, narrowest) != current:
+                wider = numpy.promote_types(current, narrowest)
+                self.retype(get_widest_dtype(wider))
+
+        Dataset.write(self, begin, end, ndarray)
+
+    def buffered_ndarray(self, rows):
+        """
+        Before the first chunk is written, the dtype of dset is only a
+        placeholder, and afterwards the buffered rows may not fit in it, so
+        they keep their own dtype (promoted with the dtype of dset).
+        """
+        if not len(rows):
+            return Dataset.buffered_ndarray(self, rows)
+
+        ndarray = numpy.array(rows)
+        if self.narrowed:
+            ndarray = ndarray.astype(numpy.result_type(self.dset.dtype,
+                                                       ndarray.dtype))
+        return ndarray.reshape(sum(((len(rows),), self.arr_shape), ()))
+
+
+class RunLengthDataset(object):
+    """
+    Stores a stream of values as a change-log: a row (start_index, value) is
+    recorded only when the value differs from the previous one. The change-log
+    is buffered and written in chunks, just like the dbuffer of a Dataset.
+    """
+    def __init__(self, group, arr_shape, chunksize, dtype):
+        """
+        Parameters
+        ----------
+        group: h5py Group
+            The group in which the datasets 'index' and 'value' are created.
+
+        arr_shape: tuple
+            The shape of a single value.
+
+        chunksize: int
+            Number of changes per chunk.
+
+        dtype: numpy dtype of the values.
+        """
+        self.group = group
+        self.name = group.name
+        self.chunksize = chunksize
+        self.arr_shape = arr_shape
+
+        self.index = group.create_dataset(
+            'index', shape=(0,), maxshape=(None,), chunks=(chunksize,),
+            dtype='int64')
+        self.value = group.create_dataset(
+            'value', shape=sum(((0,), arr_shape), ()),
+            maxshape=sum(((None,), arr_shape), ()),
+            chunks=sum(((chunksize,), arr_shape), ()), dtype=dtype)
+
+        group.attrs['encoding'] = 'rle'
+        group.attrs['length'] = 0
+
+        self.length = 0
+        self.last = None
+        self.ibuffer = list()
+        self.dbuffer = list()
+        self.lock = threading.Lock()
+        self.checkpointed = 0
+        self.wal = None
+        self.nbytes = 0
+        self.nbytes_counted = 0
+
+    def rebind(self, h5file):
+        """
+        Continue with the group of the same name in (the reopened) h5file.
+        """
+        self.group = h5file[self.name]
+        self.index = self.group['index']
+        self.value = self.group['value']
+
+    def save_checkpoint(self, length):
+        """
+        Writes the buffered changes and records that the first length rows
+        are valid, where length must be the current length. See
+        hdf5handler.checkpoint.
+        """
+        self.write()
+        self.group.attrs[VALID_LENGTH] = length
+        self.checkpointed = length
+
+    def append_to_dbuffer(self, array):
+        """
+        Parameters
+        ----------
+        array: ndarray
+
+        """
+        if self.last is None or not same_values(array, self.last):
+            self.ibuffer.append(self.length)
+            self.dbuffer.append(array)
+            self.last = array
+
+            if len(self.dbuffer) == self.chunksize:
+                self.write()
+
+        self.length += 1
+
+    def extend(self, ndarray):
+        """
+        Appends all rows of ndarray.
+        """
+        for array in ndarray:
+            self.append_to_dbuffer(array)
+
+    def __len__(self):
+        return self.length
+
+    def __getitem__(self, key):
+        """
+        Reads rows (in dense form) from the change-log on disk and in the
+        buffer. See hdf5handler.reader.RunLengthReader.
+        """
+        shape = sum(((len(self.dbuffer),), self.arr_shape), ())
+        index = numpy.append(self.index[...], self.ibuffer).astype('int64')
+        value = numpy.concatenate((self.value[...], numpy.array(
+            self.dbuffer, dtype=self.value.dtype).reshape(shape)))
+        return Runs(index, value, self.length)[key]
+
+    def write(self):
+        """
+        Appends the buffered changes to the change-log.
+        """
+        begin = self.index.shape[0]
+        end = begin + len(self.ibuffer)
+
+        if end > begin:
+            self.index.resize((end,))
+            self.value.resize(sum(((end,), self.arr_shape), ()))
+            self.index[begin:end] = self.ibuffer
+            self.value[begin:end, ...] = numpy.array(self.dbuffer)
+            self.nbytes += (end - begin) * (self.index.dtype.itemsize +
+                self.value.dtype.itemsize * int(numpy.prod(self.arr_shape)))
+            self.ibuffer = list()
+            self.dbuffer = list()
+
+        self.group.attrs['length'] = self.length
+
+    def flush(self, trim=True):
+        """
+        Writes the buffered changes and the current length.
+        """
+        self.write()
+
+
+def same_values(a, b):
+    """
+    True if the arrays (or scalars) a and b are equal, where NaNs are
+    considered equal to each other.
+    """
+    equal = (a == b)
+    if numpy.all(equal):
+        return True
+    try:
+        return bool(numpy.all(equal | (numpy.isnan(a) & numpy.isnan(b))))
+    except TypeError:
+        return False
+
+
+def copy_dataset(dset, group, name, nrows, blocksize, **dsetkw):
+    """
+    Creates group[name] with the shape, attributes and creation properties
+    of dset, except for those given in dsetkw, and copies the first nrows
+    rows of dset to it, in blocks of blocksize rows, so that memory usage
+    stays bounded.
+
+    Return
+    ------
+    The new h5py Dataset.
+    """
+    kwargs = dict(shape=dset.shape, dtype=dset.dtype, chunks=dset.chunks,
+                  maxshape=dset.maxshape, compression=dset.compression,
+                  compression_opts=dset.compression_opts,
+                  shuffle=dset.shuffle, fletcher32=dset.fletcher32,
+                  scaleoffset=dset.scaleoffset)
+    kwargs.update(dsetkw)
+
+    new = group.create_dataset(name, **kwargs)
+
+    for begin in range(0, nrows, blocksize):
+        end = min(begin + blocksize, nrows)
+        new[begin:end, ...] = dset[begin:end, ...]
+
+    for key, value in dset.attrs.items():
+        new.attrs[key] = value
+    return new
+
+
+def rewrite_dataset(dset, nrows, blocksize, **dsetkw):
+    """
+    Replaces dset by a copy with the same name (see copy_dataset).
+
+    Return
+    ------
+    The new h5py Dataset.
+    """
+    name = dset.name
+    h5file = dset.file
+
+    tmpname = name + '~'
+    copy_dataset(dset, h5file, tmpname, nrows, blocksize, **dsetkw)
+
+    del h5file[name]
+    h5file.move(tmpname, name)
+    return h5file[name]
+
+
+def copy_group(source, dest, contiguous=(), copysize=2**24):
+    """
+    Copies the attributes and all members of the h5py Group source to the
+    Group dest. The datasets whose names are in contiguous get contiguous
+    storage, everything else is copied as it is by HDF5.
+
+    Parameters
+    ----------
+    copysize : int
+        The contiguous datasets are copied in blocks of at most copysize
+        bytes (or one row).
+    """
+    for key, value in source.attrs.items():
+        dest.attrs[key] = value
+
+    for name, obj in source.items():
+        if isinstance(obj, h5py.Group) and \
+           any(path.startswith(obj.name + '/') for path in contiguous):
+            copy_group(obj, dest.create_group(name), contiguous, copysize)
+        elif obj.name in contiguous:
+            rowsize = max(1, obj.nbytes // max(1, len(obj)))
+            blocksize = max(1, copysize // rowsize)
+            copy_dataset(obj, dest, name, len(obj), blocksize, chunks=None,
+                         maxshape=None)
+        else:
+            source.copy(obj, dest, name=name)
+
+
+def get_chunkshape(policy, chunksize, arr_shape, dtype, target=2**20,
+                   tile=64):
+    """
+    Returns the chunk shape of a dataset of records of shape arr_shape. See
+    the chunks argument of HDF5Handler.create_dset.
+
+    Parameters
+    ----------
+    policy : 'append', 'record', 'roi' or a tuple
+
+    chunksize : int
+        Number of records that are written at once.
+
+    arr_shape : tuple
+        Shape of a single record.
+
+    dtype : numpy dtype of the dataset.
+
+    target : int
+        Approximate size in bytes of a chunk with the 'roi' policy.
+
+    tile : int
+        Maximum extent of a chunk in the dimensions of a record with the
+        'roi' policy.
+    """
+    if not isinstance(policy, str):
+        chunkshape = tuple(policy)
+        if len(chunkshape) != len(arr_shape) + 1 or chunksize % chunkshape[0]:
+            msg = "chunks {} do not match records of shape {} and chunksize "\
+                  "{}".format(chunkshape, arr_shape, chunksize)
+            raise ValueError(msg)
+        return chunkshape
+
+    if policy not in ('append', 'record', 'roi'):
+        raise ValueError("Unknown chunks policy: {}".format(policy))
+
+    if policy == 'append' or arr_shape == ():
+        return sum(((chunksize,), arr_shape), ())
+    elif policy == 'record':
+        return sum(((1,), arr_shape), ())
+
+    tiles = tuple(min(tile, extent) for extent in arr_shape)
+    tilesize = numpy.dtype(dtype).itemsize * int(numpy.prod(tiles))
+    nrecords = max(1, min(chunksize, target // max(1, tilesize)))
+    while chunksize % nrecords: # LARGEST DIVISOR OF CHUNKSIZE <= nrecords
+        nrecords -= 1
+    return sum(((nrecords,), tiles), ())
+
+
+def is_filtered(dset):
+    """ True if any HDF5 filter (compression, checksum, ...) is applied. """
+    return dset.compression is not None or dset.shuffle or \
+           dset.fletcher32 or dset.scaleoffset is not None
+
+
+def get_narrowest_dtype(ndarray):
+    """
+    Returns the narrowest numpy dtype that can hold all values of ndarray
+    without loss. Integral floats (e.g. 3.0) are considered to be integers.
+    """
+    kind = ndarray.dtype.kind
+
+    if kind == 'f' and is_integral(ndarray):
+        kind = 'i'
+
+    if kind in 'biu' and ndarray.size:
+        low, high = ndarray.min(), ndarray.max()
+        for dtype in ('uint8', 'int8', 'uint16', 'int16', 'uint32', 'int32',
+                      'int64', 'uint64'):
+            info = numpy.iinfo(dtype)
+            if info.min <= low and high <= info.max:
+                return numpy.dtype(dtype)
+
+    if kind in 'biuf':
+        for dtype in ('float16', 'float32'):
+            with numpy.errstate(over='ignore'):
+                narrowed = ndarray.astype(dtype)
+            equal = (narrowed == ndarray)
+            if kind == 'f':
+                equal |= numpy.isnan(ndarray)
+            if equal.all():
+                return numpy.dtype(dtype)
+        return numpy.promote_types(ndarray.dtype, 'float64')
+
+    return ndarray.dtype
+
+
+def get_widest_dtype(dtype):
+    """
+    Returns the 64-bit dtype of the same kind as dtype (int64 for signed and
+    unsigned integers, unless dtype is uint64).
+    """
+    if dtype.kind in 'biu' and dtype != numpy.dtype('uint64'):
+        return numpy.dtype('int64')
+    elif dtype.kind == 'f':
+        return numpy.promote_types(dtype, 'float64')
+    elif dtype.kind == 'c':
+        return numpy.promote_types(dtype, 'complex128')
+    else:
+        return dtype
+
+
+def is_integral(ndarray):
+    """
+    True if all values of the floating point ndarray are integers, i.e. no
+    fractions, NaNs, infs or negative zeros.
+    """
+    if not numpy.isfinite(ndarray).all():
+        return False
+    if not (numpy.floor(ndarray) == ndarray).all():
+        return False
+    return not numpy.signbit(ndarray[ndarray == 0]).any()
+
+
+def get_scaleoffset(tolerance):
+    """
+    Returns the decimal scale factor D of HDF5's scale-offset filter, such
+    that rounding to D decimals is accurate within the absolute tolerance.
+    (Rounding to D decimals has a maximum error of 0.5*10**-D).
+    """
+    if tolerance <= 0:
+        raise ValueError("tolerance must be positive, got {}".format(tolerance))
+    return max(0, int(math.ceil(-math.log10(2.0*tolerance))))
+
+
+SCALAR_TYPES = (int, float, bool, numpy.number, numpy.bool_)
 
 
 def get_ndarray_converter(data):
@@ -350,7 +1477,7 @@ def get_ndarray_converter(data):
     elif isinstance(data, (list, tuple)):
         return numpy.array
 
-    elif isinstance(data, (int, float, bool, numpy.number)):
+    elif isinstance(data, SCALAR_TYPES):
         return identity
 
     else:
@@ -367,7 +1494,7 @@ def get_shape(data):
     ------
     returns () if it is a scalar, else it returns numpy.array(data).shape """
 
-    if isinstance(int, float):
+    if isinstance(data, SCALAR_TYPES):
         return ()
     else:
         return numpy.array(data).shape
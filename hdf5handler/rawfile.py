@@ -0,0 +1,501 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+A storage backend without HDF5: every dataset is an append-only raw binary
+file with a JSON header, and every group is a directory.
+
+    mydata/             <-- RawFile('mydata')
+    ├── .attrs.json         attributes of the root group
+    └── somepath/       <-- group
+        ├── .attrs.json
+        ├── scalars.bin     raw C-ordered data
+        └── scalars.json    {"dtype": "<f8", "shape": [1000], ...}
+
+RawFile, RawGroup and RawDataset implement the subset of the h5py File,
+Group and Dataset API that the HDF5Handler uses, so that
+
+>>> with HDF5Handler('mydata', backend='raw') as handler:
+...     handler.put(1.0, 'somepath/scalars')
+
+writes the same structure as it would with h5py. The data can be read without
+any HDF5 library:
+
+>>> data = numpy.memmap('mydata/somepath/scalars.bin', mode='r',
+...                     **read_header('mydata/somepath/scalars.json'))
+
+or converted to an HDF5 file afterwards with raw_to_hdf5.
+"""
+
+import os
+import json
+import shutil
+import argparse
+import numpy
+
+ATTRS = '.attrs.json'
+
+
+def dtype_to_json(dtype):
+    """ A JSON serializable description of a numpy dtype. """
+    if dtype.fields is None:
+        return dtype.str
+    return dtype.descr
+
+
+def dtype_from_json(descr):
+    """ Inverse of dtype_to_json. """
+    if isinstance(descr, list):
+        return numpy.dtype([tuple(field) for field in descr])
+    return numpy.dtype(descr)
+
+
+def to_json(value):
+    """ Converts numpy scalars and arrays to JSON serializable objects. """
+    if hasattr(value, 'tolist'):
+        return value.tolist()
+    return value
+
+
+def read_header(filename):
+    """
+    Returns the dtype and shape of a raw dataset from its JSON header, as
+    keyword arguments for numpy.memmap.
+    """
+    with open(filename) as header:
+        header = json.load(header)
+    return dict(dtype=dtype_from_json(header['dtype']),
+                shape=tuple(header['shape']))
+
+
+class RawAttrs(dict):
+    """
+    A dict that is written to its JSON file whenever it is modified.
+    """
+    def __init__(self, save, *args):
+        dict.__init__(self, *args)
+        self.save = save
+
+    def __setitem__(self, key, value):
+        dict.__setitem__(self, key, to_json(value))
+        self.save()
+
+    def __delitem__(self, key):
+        dict.__delitem__(self, key)
+        self.save()
+
+    def update(self, *args, **kwargs):
+        for key, value in dict(*args, **kwargs).items():
+            dict.__setitem__(self, key, to_json(value))
+        self.save()
+
+
+class RawGroup(object):
+    """ A directory. See the module docstring. """
+    def __init__(self, rawfile, name):
+        self.file = rawfile
+        self.name = name
+        self.path = rawfile.ospath(name)
+
+        attrs = dict()
+        if os.path.exists(os.path.join(self.path, ATTRS)):
+            with open(os.path.join(self.path, ATTRS)) as attrsfile:
+                attrs = json.load(attrsfile)
+        self.attrs = RawAttrs(self.save, attrs)
+
+    def save(self):
+        """ Writes the attributes of the group. """
+        with open(os.path.join(self.path, ATTRS), 'w') as attrsfile:
+            json.dump(self.attrs, attrsfile)
+
+    def join(self, name):
+        """ The absolute name of name, relative to this group. """
+        if name.startswith('/'):
+            return self.file.normalize(name)
+        return self.file.normalize(self.name + '/' + name)
+
+    def create_dataset(self, name, **kwargs):
+        return self.file.create_dataset(self.join(name), **kwargs)
+
+    def create_group(self, name):
+        return self.file.create_group(self.join(name))
+
+    def require_group(self, name):
+        return self.file.require_group(self.join(name))
+
+    def __getitem__(self, name):
+        return self.file[self.join(name)]
+
+    def __contains__(self, name):
+        return self.join(name) in self.file
+
+    def __delitem__(self, name):
+        del self.file[self.join(name)]
+
+    def keys(self):
+        names = set()
+        for entry in os.listdir(self.path):
+            if entry == ATTRS:
+                continue
+            elif os.path.isdir(os.path.join(self.path, entry)):
+                names.add(entry)
+            elif entry.endswith('.json'):
+                names.add(entry[:-len('.json')])
+        return sorted(names)
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __len__(self):
+        return len(self.keys())
+
+    def visititems(self, func):
+        """ Calls func(name, obj) for all members, like h5py's visititems."""
+        for key in self.keys():
+            obj = self[key]
+            result = func(obj.name.lstrip('/'), obj)
+            if result is not None:
+                return result
+            if isinstance(obj, RawGroup):
+                result = obj.visititems(func)
+                if result is not None:
+                    return result
+
+
+class RawFile(RawGroup):
+    """
+    A directory of raw datasets that can be used instead of an h5py File.
+    See the module docstring.
+    """
+    def __init__(self, directory, mode='a'):
+        """
+        Parameters
+        ----------
+        directory : str
+            The directory of the raw file.
+
+        mode : str
+            'r' read-only, 'w' create (removes an existing raw file) or 'a'
+            read/write (create if it does not exist).
+        """
+        self.directory = directory
+        self.mode = mode
+        self.datasets = dict()
+
+        exists = os.path.exists(os.path.join(directory, ATTRS))
+
+        if mode == 'w' and os.path.isdir(directory):
+            if not exists and os.listdir(directory):
+                msg = "{} is not empty and not a raw file".format(directory)
+                raise IOError(msg)
+            shutil.rmtree(directory)
+            exists = False
+        elif mode == 'r' and not exists:
+            raise IOError("{} is not a raw file".format(directory))
+
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+        RawGroup.__init__(self, self, '/')
+        if not exists:
+            self.save()
+
+    @staticmethod
+    def normalize(name):
+        return '/' + '/'.join(part for part in name.split('/') if part)
+
+    def ospath(self, name):
+        """ The location on disk of the object with the given name. """
+        parts = [part for part in name.split('/') if part]
+        return os.path.join(self.directory, *parts)
+
+    def create_dataset(self, name, shape=None, dtype=None, data=None,
+                       chunks=None, maxshape=None, compression=None,
+                       compression_opts=None, shuffle=False, fletcher32=False,
+                       scaleoffset=None):
+        """
+        Like h5py.Group.create_dataset, except that filters are not supported.
+        """
+        if compression or shuffle or fletcher32 or scaleoffset is not None:
+            raise ValueError("The raw backend does not support filters")
+
+        name = self.normalize(name)
+        if name in self:
+            raise ValueError("{} already exists".format(name))
+
+        if data is not None:
+            data = numpy.asarray(data, dtype=dtype)
+            shape, dtype = data.shape, data.dtype
+
+        parent = os.path.dirname(self.ospath(name))
+        if not os.path.isdir(parent):
+            os.makedirs(parent)
+
+        dset = RawDataset(self, name, shape=shape, dtype=numpy.dtype(dtype),
+                          chunks=chunks, maxshape=maxshape)
+        self.datasets[name] = dset
+
+        if data is not None:
+            dset[...] = data
+        return dset
+
+    def create_group(self, name):
+        name = self.normalize(name)
+        if name in self:
+            raise ValueError("{} already exists".format(name))
+        os.makedirs(self.ospath(name))
+        group = RawGroup(self, name)
+        group.save()
+        return group
+
+    def require_group(self, name):
+        name = self.normalize(name)
+        if name in self:
+            return self[name]
+        return self.create_group(name)
+
+    def __getitem__(self, name):
+        name = self.normalize(name)
+        if name in self.datasets:
+            return self.datasets[name]
+
+        path = self.ospath(name)
+        if os.path.isdir(path):
+            return RawGroup(self, name)
+        elif os.path.exists(path + '.json'):
+            self.datasets[name] = RawDataset(self, name)
+            return self.datasets[name]
+        else:
+            raise KeyError("{} does not exist".format(name))
+
+    def __contains__(self, name):
+        path = self.ospath(self.normalize(name))
+        return os.path.isdir(path) or os.path.exists(path + '.json')
+
+    def __delitem__(self, name):
+        name = self.normalize(name)
+        obj = self[name]
+        if isinstance(obj, RawDataset):
+            obj.close()
+            os.remove(obj.path + '.json')
+            os.remove(obj.path + '.bin')
+            del self.datasets[name]
+        else:
+            for dname in list(self.datasets):
+                if dname.startswith(name + '/'):
+                    self.datasets.pop(dname).close()
+            shutil.rmtree(obj.path)
+
+    def move(self, source, dest):
+        source = self.normalize(source)
+        dest = self.normalize(dest)
+        obj = self[source]
+        if isinstance(obj, RawDataset):
+            obj.close()
+            del self.datasets[source]
+            os.rename(obj.path + '.json', self.ospath(dest) + '.json')
+            os.rename(obj.path + '.bin', self.ospath(dest) + '.bin')
+        else:
+            self.flush()
+            self.datasets = dict()
+            os.rename(obj.path, self.ospath(dest))
+
+    def flush(self):
+        for dset in self.datasets.values():
+            dset.flush()
+
+    def close(self):
+        for dset in self.datasets.values():
+            dset.close()
+        self.datasets = dict()
+
+
+class RawDataset(object):
+    """
+    An append-only raw binary file with a JSON header. See the module
+    docstring.
+
+    Only selections of whole rows (dset[i], dset[begin:end, ...] and
+    dset[...]) are supported.
+    """
+    compression = None
+    compression_opts = None
+    shuffle = False
+    fletcher32 = False
+    scaleoffset = None
+
+    def __init__(self, rawfile, name, shape=None, dtype=None, chunks=None,
+                 maxshape=None):
+        self.file = rawfile
+        self.name = name
+        self.path = rawfile.ospath(name)
+
+        if shape is None:
+            with open(self.path + '.json') as header:
+                header = json.load(header)
+            self.dtype = dtype_from_json(header['dtype'])
+            self.shape = tuple(header['shape'])
+            self.chunks = tuple(header['chunks'] or ()) or None
+            self.maxshape = tuple(header['maxshape'])
+            attrs = header['attrs']
+        else:
+            self.dtype = dtype
+            self.shape = tuple(shape)
+            self.chunks = tuple(chunks) if chunks else None
+            self.maxshape = tuple(maxshape) if maxshape else self.shape
+            attrs = dict()
+
+        self.attrs = RawAttrs(self.save, attrs)
+        self.rowsize = self.dtype.itemsize * int(numpy.prod(self.shape[1:]))
+
+        if rawfile.mode == 'r':
+            self.data = open(self.path + '.bin', 'rb')
+        else:
+            if not os.path.exists(self.path + '.bin'):
+                open(self.path + '.bin', 'wb').close()
+            self.data = open(self.path + '.bin', 'r+b')
+            self.save()
+
+    def save(self):
+        """ Writes the JSON header. """
+        header = dict(dtype=dtype_to_json(self.dtype), shape=self.shape,
+                      chunks=self.chunks, maxshape=self.maxshape,
+                      attrs=self.attrs)
+        with open(self.path + '.json', 'w') as headerfile:
+            json.dump(header, headerfile)
+
+    def __len__(self):
+        return self.shape[0]
+
+    @property
+    def size(self):
+        return int(numpy.prod(self.shape))
+
+    def rows(self, key):
+        """ Returns (begin, end, scalar) of a selection of whole rows. """
+        if isinstance(key, tuple):
+            if len(key) == 2 and key[1] is Ellipsis:
+                key = key[0]
+            elif key == ():
+                key = Ellipsis
+            else:
+                raise TypeError("Unsupported selection {}".format(key))
+
+        if key is Ellipsis:
+            return 0, self.shape[0], False
+        elif isinstance(key, slice):
+            begin, end, step = key.indices(self.shape[0])
+            if step != 1:
+                raise ValueError("Unsupported selection {}".format(key))
+            return begin, max(begin, end), False
+        else:
+            index = int(key)
+            if index < 0:
+                index += self.shape[0]
+            if not 0 <= index < self.shape[0]:
+                raise IndexError("index {} is out of range".format(key))
+            return index, index + 1, True
+
+    def __getitem__(self, key):
+        begin, end, scalar = self.rows(key)
+
+        self.data.seek(begin*self.rowsize)
+        buf = self.data.read((end - begin)*self.rowsize)
+
+        # Rows that were allocated by resize, but never written, read as zeros
+        array = numpy.zeros((end - begin,) + self.shape[1:], dtype=self.dtype)
+        array.reshape(-1).view('u1')[:len(buf)] = numpy.frombuffer(buf, 'u1')
+
+        if scalar:
+            return array[0]
+        return array
+
+    def __setitem__(self, key, value):
+        begin, end, scalar = self.rows(key)
+        shape = (end - begin,) + self.shape[1:]
+
+        array = numpy.asarray(value)
+        if array.dtype != self.dtype:
+            array = array.astype(self.dtype)
+        array = numpy.ascontiguousarray(numpy.broadcast_to(array, shape))
+
+        self.data.seek(begin*self.rowsize)
+        self.data.write(array.tobytes())
+
+    def resize(self, shape):
+        shape = tuple(shape)
+        if shape[1:] != self.shape[1:]:
+            raise ValueError("Only the first axis of a raw dataset can be "
+                             "resized")
+        if shape[0] < self.shape[0]:
+            self.data.truncate(shape[0]*self.rowsize)
+        self.shape = shape
+        self.save()
+
+    def flush(self):
+        self.data.flush()
+        self.save()
+
+    def close(self):
+        if not self.data.closed:
+            if self.file.mode != 'r':
+                self.flush()
+            self.data.close()
+
+
+def raw_to_hdf5(directory, filename, blocksize=2**20):
+    """
+    Converts a raw file to an HDF5 file with the same groups, datasets and
+    attributes.
+
+    Parameters
+    ----------
+    directory : str
+        The directory of the raw file.
+
+    filename : str
+        The HDF5 file to write.
+
+    blocksize : int
+        Number of rows that are copied at a time.
+    """
+    import h5py
+
+    rawfile = RawFile(directory, 'r')
+
+    with h5py.File(filename, 'w', libver='latest') as h5file:
+        h5file.attrs.update(rawfile.attrs)
+
+        def convert(name, obj):
+            if isinstance(obj, RawGroup):
+                group = h5file.require_group(name)
+                group.attrs.update(obj.attrs)
+                return
+
+            dset = h5file.create_dataset(name, shape=obj.shape,
+                                         dtype=obj.dtype, chunks=obj.chunks,
+                                         maxshape=obj.maxshape)
+            data = numpy.memmap(obj.path + '.bin', mode='r', dtype=obj.dtype,
+                                shape=obj.shape) if obj.size else None
+            for begin in range(0, obj.shape[0], blocksize):
+                end = min(begin + blocksize, obj.shape[0])
+                dset[begin:end, ...] = data[begin:end]
+            dset.attrs.update(obj.attrs)
+
+        rawfile.visititems(convert)
+
+    rawfile.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Convert a raw file written with HDF5Handler(..., "
+                    "backend='raw') to an HDF5 file.")
+    parser.add_argument('directory', help="the raw file (a directory)")
+    parser.add_argument('filename', help="the HDF5 file to write")
+    args = parser.parse_args()
+
+    raw_to_hdf5(args.directory, args.filename)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,367 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Functions to read the files written by the HDF5Handler.
+"""
+
+import functools
+import multiprocessing
+import numpy
+import h5py
+
+from .sidecars import ChunkStats, sidecar_path
+from .checkpoint import VALID_LENGTH
+
+
+def chunk_stats(dset):
+    """
+    Parameters
+    ----------
+    dset : h5py Dataset
+        A dataset written with HDF5Handler.put(..., stats=True)
+
+    Return
+    ------
+    A structured ndarray with the fields 'min', 'max', 'count' (and
+    'nancount' if requested at write time), one row per chunk.
+    """
+    path = sidecar_path(ChunkStats.kind, dset.name)
+    try:
+        return dset.file[path][...]
+    except KeyError:
+        raise KeyError("No chunk statistics recorded for {}".format(dset.name))
+
+
+def select_chunks(dset, lower=None, upper=None):
+    """
+    Returns the indices of the chunks of dset that may contain values v with
+    lower <= v <= upper. Chunks whose statistics cannot match are skipped,
+    as are chunks that contain only NaNs.
+
+    Parameters
+    ----------
+    dset : h5py Dataset
+        A dataset written with HDF5Handler.put(..., stats=True)
+
+    lower, upper : number or None
+        Inclusive bounds of the predicate. None means unbounded.
+    """
+    return _select(chunk_stats(dset), lower, upper)
+
+
+def _select(stats, lower, upper):
+    mask = stats['count'] > 0
+    if lower is not None:
+        mask &= stats['max'] >= lower
+    if upper is not None:
+        mask &= stats['min'] <= upper
+    return mask.nonzero()[0]
+
+
+def iter_chunks(dset, lower=None, upper=None):
+    """
+    Yields (begin, ndarray) for every chunk of dset that may contain values v
+    with lower <= v <= upper, where ndarray is dset[begin:begin+len(ndarray)].
+    Only those chunks are read from the file. Note that the rows of a chunk
+    are not filtered, e.g.:
+
+    >>> for begin, chunk in iter_chunks(f['energy'], lower=threshold):
+    ...     hits = chunk[chunk >= threshold]
+
+    Parameters
+    ----------
+    See select_chunks.
+    """
+    stats = chunk_stats(dset)
+    sidecar = dset.file[sidecar_path(ChunkStats.kind, dset.name)]
+    chunksize = int(sidecar.attrs['chunksize'])
+
+    for index in _select(stats, lower, upper):
+        begin = int(index) * chunksize
+        end = begin + int(stats['count'][index])
+        yield begin, dset[begin:end, ...]
+
+
+class Runs(object):
+    """
+    A stream of values stored as runs: value[k] repeats from row index[k] up
+    to index[k+1] (or length). Indexing returns dense rows, see
+    RunLengthReader.
+    """
+    def __init__(self, index, value, length):
+        """
+        Parameters
+        ----------
+        index : ndarray
+            The first row of every run, in increasing order.
+
+        value : ndarray or h5py Dataset
+            The value of every run.
+
+        length : int
+            The total number of rows.
+        """
+        self.index = index
+        self.value = value
+        self.length = length
+
+        self.dtype = value.dtype
+        self.shape = (length,) + value.shape[1:]
+
+    def __len__(self):
+        return self.length
+
+    def run(self, i):
+        """ Returns the number of the run that contains row i. """
+        return int(numpy.searchsorted(self.index, i, side='right')) - 1
+
+    def __getitem__(self, key):
+        if key is Ellipsis:
+            key = slice(None)
+
+        if isinstance(key, slice):
+            start, stop, step = key.indices(self.length)
+            if step < 0:
+                return self[slice(stop + 1, start + 1)][::step]
+            if stop <= start:
+                return numpy.empty((0,) + self.shape[1:], dtype=self.dtype)
+
+            first, last = self.run(start), self.run(stop - 1)
+            bounds = numpy.clip(self.index[first:last + 2], start, stop)
+            if len(bounds) == last - first + 1:
+                bounds = numpy.append(bounds, stop)
+
+            values = self.value[first:last + 1, ...]
+            return numpy.repeat(values, numpy.diff(bounds), axis=0)[::step]
+
+        i = int(key)
+        if i < 0:
+            i += self.length
+        if not 0 <= i < self.length:
+            raise IndexError("index {} is out of range".format(key))
+        return self.value[self.run(i)]
+
+
+class RunLengthReader(Runs):
+    """
+    Reads a group written with HDF5Handler.put(..., encoding='rle') as if it
+    were a dense array, without expanding more rows than requested:
+
+    >>> setpoint = RunLengthReader(f['setpoint'])
+    >>> len(setpoint)       # number of puts
+    >>> setpoint[12345]     # value of the 12345th put, by binary search
+    >>> setpoint[1000:2000] # dense ndarray of 1000 rows
+    >>> setpoint[...]       # the whole stream as a dense ndarray
+    """
+    def __init__(self, group):
+        """
+        Parameters
+        ----------
+        group : h5py Group
+            Written with encoding='rle'.
+        """
+        if group.attrs.get('encoding') != 'rle':
+            raise ValueError("{} is not run-length encoded".format(group.name))
+
+        self.group = group
+        Runs.__init__(self, group['index'][...], group['value'],
+                      int(group.attrs['length']))
+
+
+def memmap(filename, path):
+    """
+    Maps a contiguous dataset directly into memory with numpy.memmap, which
+    gives zero-copy random access without h5py. Datasets are contiguous if
+    they were written with HDF5Handler(..., finalize='contiguous').
+
+    Parameters
+    ----------
+    filename : str
+        The HDF5 file.
+
+    path : str
+        The path of the dataset in the file.
+
+    Return
+    ------
+    A read-only numpy.memmap (or an empty ndarray if the dataset is empty).
+    """
+    with h5py.File(filename, 'r') as h5file:
+        dset = h5file[path]
+        if dset.chunks is not None:
+            raise ValueError("{} is not contiguous".format(path))
+        dtype, shape = dset.dtype, dset.shape
+        offset = dset.id.get_offset()
+
+    if offset is None: # Nothing was written, so no storage was allocated.
+        return numpy.zeros(shape, dtype=dtype)
+    return numpy.memmap(filename, dtype=dtype, mode='r', offset=offset,
+                        shape=shape)
+
+
+def get_length(dset):
+    """
+    The number of valid rows of dset: its VALID_LENGTH attribute, if it was
+    written with checkpoints (see hdf5handler.checkpoint), else its length.
+    A scalar dataset counts as a single row, an empty (null) one as none.
+    """
+    if dset.shape is None:
+        return 0
+    if dset.shape == ():
+        return 1
+    if VALID_LENGTH in dset.attrs:
+        return min(int(dset.attrs[VALID_LENGTH]), dset.shape[0])
+    return dset.shape[0]
+
+
+def chunk_ranges(dset, maxbytes=2**24):
+    """
+    Returns the (begin, end) row ranges of the chunks of dset, up to its
+    valid length. Chunks larger than maxbytes, and contiguous datasets, are
+    divided in ranges of at most maxbytes bytes (or one row), which never
+    span two chunks.
+    """
+    length = get_length(dset)
+    if not dset.shape: # SCALAR OR EMPTY
+        return [(0, length)] if length else []
+    recordsize = dset.dtype.itemsize * int(numpy.prod(dset.shape[1:]))
+    step = max(1, maxbytes // max(1, recordsize))
+    chunk = length if dset.chunks is None else dset.chunks[0]
+
+    ranges = list()
+    for first in range(0, length, max(1, chunk)):
+        last = min(first + chunk, length) # NEVER CROSS A CHUNK BOUNDARY
+        ranges.extend((begin, min(begin + step, last))
+                      for begin in range(first, last, step))
+    return ranges
+
+
+def read_rows(dset, begin, end):
+    """ Rows begin:end of dset, where a scalar dataset is a single row. """
+    if dset.shape == ():
+        return numpy.array(dset[()])[numpy.newaxis][begin:end]
+    return dset[begin:end, ...]
+
+
+def split_ranges(ranges, ntasks):
+    """
+    Divides a list of ranges in at most ntasks contiguous groups of about
+    equal length. (More tasks than workers balances the load.)
+    """
+    ntasks = max(1, min(len(ranges), ntasks))
+    bounds = numpy.linspace(0, len(ranges), ntasks + 1).astype(int)
+    return [ranges[begin:end] for begin, end in zip(bounds[:-1], bounds[1:])
+            if end > begin]
+
+
+def split_chunk_ranges(dset, ranges, ntasks):
+    """
+    split_ranges of the ranges of chunk_ranges(dset), where the ranges of a
+    chunk are always kept in the same group, so that no chunk is read (and
+    decompressed) by two workers.
+    """
+    if dset.chunks is None:
+        return split_ranges(ranges, ntasks)
+
+    chunk = dset.chunks[0]
+    bychunk = list()
+    for begin, end in ranges:
+        if bychunk and bychunk[-1][-1][0] // chunk == begin // chunk:
+            bychunk[-1].append((begin, end))
+        else:
+            bychunk.append([(begin, end)])
+
+    return [[item for parts in group for item in parts]
+            for group in split_ranges(bychunk, ntasks)]
+
+
+def parallel_map(func, tasks, workers):
+    """
+    Returns [func(task) for task in tasks], computed by a pool of workers
+    processes, or in this process if workers is 1.
+    """
+    if workers == 1:
+        return [func(task) for task in tasks]
+
+    pool = multiprocessing.Pool(workers)
+    try:
+        return pool.map(func, tasks, chunksize=1)
+    finally:
+        pool.close()
+        pool.join()
+
+
+def _map_ranges(args):
+    """ Worker of map_chunks. """
+    filename, path, func, reduce, ranges = args
+
+    results = list()
+    with h5py.File(filename, 'r') as h5file:
+        dset = h5file[path]
+        for begin, end in ranges:
+            result = func(read_rows(dset, begin, end))
+            if reduce is not None and results:
+                results = [reduce(results[0], result)]
+            else:
+                results.append(result)
+    return results
+
+
+def map_chunks(filename, path, func, reduce=None, workers=None,
+               maxbytes=2**24):
+    """
+    Applies func to every chunk of a dataset, in parallel processes, and
+    combines the results with reduce:
+
+    >>> total = map_chunks('mydata.hdf5', 'energy', numpy.sum, operator.add)
+
+    The chunks are divided in contiguous groups, each of which is read by a
+    worker process that opens the file read-only, so reading is parallel
+    too. Since func and reduce are sent to other processes, they must be
+    picklable, e.g. functions defined at the top level of a module.
+
+    Parameters
+    ----------
+    filename : str
+        The HDF5 file.
+
+    path : str
+        The path of the dataset in the file.
+
+    func : callable
+        Called with every chunk (an ndarray of up to chunks[0] rows), or
+        part of a chunk, see maxbytes.
+
+    reduce : callable
+        Combines two results into one, e.g. operator.add. If None, the list
+        of results of all chunks is returned, in order.
+
+    workers : int
+        Number of worker processes. None means one per CPU, 1 means that
+        everything is done in this process.
+
+    maxbytes : int
+        Chunks larger than maxbytes are passed to func in parts, so that
+        every worker holds at most maxbytes of data at a time.
+
+    Return
+    ------
+    The combined result (None if the dataset is empty), or a list.
+    """
+    if workers is None:
+        workers = multiprocessing.cpu_count()
+
+    with h5py.File(filename, 'r') as h5file:
+        dset = h5file[path]
+        groups = split_chunk_ranges(dset, chunk_ranges(dset, maxbytes),
+                                    4*workers)
+
+    tasks = [(filename, path, func, reduce, group) for group in groups]
+    results = parallel_map(_map_ranges, tasks, workers)
+
+    results = [result for task in results for result in task]
+    if reduce is None:
+        return results
+    elif not results:
+        return None
+    return functools.reduce(reduce, results)
@@ -0,0 +1,263 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Sidecars are small auxiliary datasets that accompany a dataset written by the
+HDF5Handler. They are updated from the in-memory chunk every time a Dataset
+writes its buffer, so they cost no extra reads.
+
+All sidecars live under the METADATA_GROUP, mirroring the path of the dataset
+they describe:
+
+    /
+    ├── _hdf5handler
+    │   ├── checksums
+    │   │   └── grp
+    │   │       └── dset    <-- per-chunk digests of /grp/dset
+    │   └── stats
+    │       └── grp
+    │           └── dset    <-- per-chunk statistics of /grp/dset
+    └── grp
+        └── dset
+"""
+
+import zlib
+import struct
+import hashlib
+import warnings
+import numpy
+
+METADATA_GROUP = '_hdf5handler'
+
+
+def sidecar_path(kind, dset_name):
+    """
+    Parameters
+    ----------
+    kind : str
+        The kind of sidecar, e.g. 'stats'.
+
+    dset_name : str
+        The (absolute) name of the h5py dataset the sidecar describes.
+
+    Return
+    ------
+    The absolute path of the sidecar dataset.
+    """
+    return '/'.join(('', METADATA_GROUP, kind, dset_name.strip('/')))
+
+
+class ChunkSidecar(object):
+    """
+    Base class of sidecars with one row per chunk of a dataset. Subclasses
+    implement update, which is called for every chunk that is written.
+    """
+    kind = None
+
+    def __init__(self, dset, chunksize, blockfactor, dtype, shape=()):
+        """
+        Parameters
+        ----------
+        dset : h5py Dataset
+            The dataset that the sidecar describes.
+
+        chunksize : int
+            Number of rows per chunk of dset.
+
+        blockfactor : int
+            Number of chunks per block of dset. The sidecar grows by this many
+            rows whenever it is full.
+
+        dtype : numpy dtype of the rows of the sidecar.
+
+        shape : tuple
+            Shape of the rows of the sidecar.
+        """
+        self.chunksize = chunksize
+        self.growth = blockfactor
+        self.nchunks = 0
+
+        self.sidecar = dset.file.create_dataset(
+            sidecar_path(self.kind, dset.name), shape=(blockfactor,) + shape,
+            maxshape=(None,) + shape, chunks=(blockfactor,) + shape,
+            dtype=dtype)
+        self.sidecar.attrs['chunksize'] = chunksize
+        self.name = self.sidecar.name
+
+    @classmethod
+    def reopen(cls, sidecar, dset):
+        """
+        Returns a sidecar that continues with the existing h5py dataset
+        sidecar, which describes dset.
+        """
+        self = cls.__new__(cls)
+        self.sidecar = sidecar
+        self.name = sidecar.name
+        self.chunksize = int(sidecar.attrs['chunksize'])
+        self.growth = sidecar.chunks[0]
+        self.nchunks = sidecar.shape[0]
+        return self
+
+    def rebind(self, h5file):
+        """
+        Continue with the sidecar of the same name in (the reopened) h5file.
+        """
+        self.sidecar = h5file[self.name]
+
+    def retype(self, dset):
+        """
+        Called when dset has been rewritten with a different dtype.
+        """
+        pass
+
+    def set(self, index, row):
+        """ Sets the row of chunk number index. """
+        if index >= self.sidecar.shape[0]:
+            self.sidecar.resize((self.sidecar.shape[0] + self.growth,) +
+                                self.sidecar.shape[1:])
+
+        self.sidecar[index] = row
+        self.nchunks = max(self.nchunks, index + 1)
+
+    def flush(self):
+        """ Trims the sidecar to the number of recorded chunks. """
+        self.sidecar.resize((self.nchunks,) + self.sidecar.shape[1:])
+
+
+class ChunkStats(ChunkSidecar):
+    """
+    Records the min, max and number of rows (and optionally the number of
+    NaNs) of every chunk written to a dataset. This is the 'zone map' that
+    allows readers to skip chunks that cannot match a value predicate (see
+    hdf5handler.reader.iter_chunks).
+    """
+    kind = 'stats'
+
+    def __init__(self, dset, chunksize, blockfactor, nancount=False):
+        """
+        Parameters
+        ----------
+        See ChunkSidecar.
+
+        nancount : bool
+            Also record the number of NaNs per chunk.
+        """
+        self.nancount = nancount
+        ChunkSidecar.__init__(self, dset, chunksize, blockfactor,
+                              self.get_dtype(dset.dtype))
+
+    def get_dtype(self, dtype):
+        """
+        The compound dtype of the sidecar for a dataset of the given dtype.
+        """
+        fields = [('min', dtype), ('max', dtype), ('count', 'int64')]
+        if self.nancount:
+            fields.append(('nancount', 'int64'))
+        return numpy.dtype(fields)
+
+    @classmethod
+    def reopen(cls, sidecar, dset):
+        self = super(ChunkStats, cls).reopen(sidecar, dset)
+        self.nancount = 'nancount' in sidecar.dtype.names
+        return self
+
+    def retype(self, dset):
+        dtype = self.get_dtype(dset.dtype)
+        if dtype == self.sidecar.dtype:
+            return
+
+        h5file = self.sidecar.file
+        rows = self.sidecar[...].astype(dtype)
+        attrs = dict(self.sidecar.attrs)
+
+        del h5file[self.name]
+        self.sidecar = h5file.create_dataset(
+            self.name, data=rows, maxshape=(None,), chunks=(self.growth,))
+        self.sidecar.attrs.update(attrs)
+
+    def update(self, begin, end, ndarray):
+        """
+        Record the statistics of ndarray, which was written to
+        dset[begin:end].
+        """
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore', RuntimeWarning) # All-NaN chunks
+            row = [numpy.nanmin(ndarray), numpy.nanmax(ndarray), end - begin]
+
+        if self.nancount:
+            if ndarray.dtype.kind in 'fc':
+                row.append(numpy.count_nonzero(numpy.isnan(ndarray)))
+            else:
+                row.append(0)
+
+        row = numpy.array(tuple(row), dtype=self.sidecar.dtype)
+        self.set(begin // self.chunksize, row)
+
+
+def get_digest(algorithm):
+    """
+    Returns (digest_size, digest) where digest(bytes) returns the digest
+    of the given algorithm as bytes of length digest_size. The algorithm is
+    'crc32', 'adler32' or any algorithm of hashlib, e.g. 'sha1' or 'md5'.
+    """
+    if algorithm in ('crc32', 'adler32'):
+        checksum = getattr(zlib, algorithm)
+        def digest(data):
+            return struct.pack('>I', checksum(data) & 0xffffffff)
+        return 4, digest
+
+    digest_size = hashlib.new(algorithm).digest_size
+    def digest(data):
+        return hashlib.new(algorithm, data).digest()
+    return digest_size, digest
+
+
+def chunk_bytes(ndarray, dtype):
+    """ The bytes of ndarray as stored in a dataset of the given dtype. """
+    return numpy.ascontiguousarray(ndarray, dtype=dtype).tobytes()
+
+
+class ChunkChecksums(ChunkSidecar):
+    """
+    Records a digest of the bytes of every chunk written to a dataset, as
+    stored in the file (i.e. in the dtype of the dataset). The digests are
+    computed from the chunk in memory, and can be verified later with
+    hdf5handler.verify.
+    """
+    kind = 'checksums'
+
+    def __init__(self, dset, chunksize, blockfactor, algorithm='crc32'):
+        """
+        Parameters
+        ----------
+        See ChunkSidecar.
+
+        algorithm : str
+            See get_digest.
+        """
+        self.algorithm = algorithm
+        self.dtype = dset.dtype
+        digest_size, self.digest = get_digest(algorithm)
+        ChunkSidecar.__init__(self, dset, chunksize, blockfactor, 'uint8',
+                              (digest_size,))
+        self.sidecar.attrs['algorithm'] = algorithm
+
+    @classmethod
+    def reopen(cls, sidecar, dset):
+        self = super(ChunkChecksums, cls).reopen(sidecar, dset)
+        self.algorithm = sidecar.attrs['algorithm']
+        self.dtype = dset.dtype
+        self.digest = get_digest(self.algorithm)[1]
+        return self
+
+    def retype(self, dset):
+        """
+        The bytes of all chunks have changed, so all digests are recomputed.
+        """
+        self.dtype = dset.dtype
+        for index in range(self.nchunks):
+            begin = index*self.chunksize
+            self.update(begin, None, dset[begin:begin+self.chunksize, ...])
+
+    def update(self, begin, end, ndarray):
+        digest = self.digest(chunk_bytes(ndarray, self.dtype))
+        self.set(begin // self.chunksize, numpy.frombuffer(digest, 'uint8'))
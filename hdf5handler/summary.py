@@ -0,0 +1,210 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Inspection of files written by the HDF5Handler:
+
+    $ hdf5handler ls mydata.hdf5
+    $ hdf5handler info mydata.hdf5 grp/dset
+    $ hdf5handler summary mydata.hdf5 --workers 8
+
+The statistics of summarize are computed while streaming over the chunks of a
+dataset (see hdf5handler.reader.map_chunks), so memory use is bounded by
+maxbytes per worker, whatever the size of the dataset.
+"""
+
+import numpy
+import h5py
+
+from .sidecars import METADATA_GROUP, sidecar_path
+from .reader import get_length, map_chunks, read_rows
+from .checkpoint import is_rle
+
+
+def walk(h5file, path='/', metadata=False):
+    """
+    Returns [(name, obj), ...] for all groups and datasets below path.
+    Run-length encoded groups are listed as a single object.
+
+    Parameters
+    ----------
+    metadata : bool
+        Also list the sidecars in the METADATA_GROUP.
+    """
+    items = list()
+    skip = list()
+
+    def visit(name, obj):
+        if not metadata and name.split('/')[0] == METADATA_GROUP:
+            return
+        if any(name.startswith(prefix) for prefix in skip):
+            return
+        if is_rle(obj):
+            skip.append(name + '/')
+        items.append((obj.name, obj))
+
+    top = h5file[path]
+    if is_rle(top) or isinstance(top, h5py.Dataset):
+        return [(top.name, top)]
+    top.visititems(visit)
+    return items
+
+
+def describe(obj):
+    """
+    Returns a dict with the shape, dtype, layout, filters and storage of a
+    dataset (or run-length encoded group), read from metadata only.
+    """
+    if is_rle(obj):
+        value = obj['value']
+        storage = obj['index'].id.get_storage_size() + \
+                  value.id.get_storage_size()
+        length = int(obj.attrs['length'])
+        info = dict(kind='rle', shape=(length,) + value.shape[1:],
+                    dtype=value.dtype, chunks=value.chunks, filters=[],
+                    runs=len(value))
+    else:
+        storage = obj.id.get_storage_size()
+        info = dict(kind='dataset', shape=obj.shape, dtype=obj.dtype,
+                    chunks=obj.chunks, filters=get_filters(obj))
+        if obj.shape and get_length(obj) != obj.shape[0]:
+            info['length'] = get_length(obj)
+
+    if info['shape'] is None: # AN EMPTY (NULL) DATASET
+        nbytes = 0
+    else:
+        nbytes = info['dtype'].itemsize * int(numpy.prod(info['shape']))
+    info['nbytes'] = nbytes
+    info['storage'] = storage
+    info['ratio'] = float(nbytes) / storage if storage else None
+
+    h5file = obj.file
+    info['sidecars'] = [kind for kind in ('stats', 'checksums')
+                        if sidecar_path(kind, obj.name) in h5file]
+    return info
+
+
+def get_filters(dset):
+    """ Returns the filters of dset as a list of str, e.g. ['gzip(4)']. """
+    filters = list()
+    if dset.scaleoffset is not None:
+        filters.append('scaleoffset({})'.format(dset.scaleoffset))
+    if dset.shuffle:
+        filters.append('shuffle')
+    if dset.compression is not None:
+        if dset.compression_opts is not None:
+            filters.append('{}({})'.format(dset.compression,
+                                           dset.compression_opts))
+        else:
+            filters.append(dset.compression)
+    if dset.fletcher32:
+        filters.append('fletcher32')
+    return filters
+
+
+def is_summarizable(dtype):
+    """ True if summarize can compute statistics for dtype. """
+    return dtype.kind in 'biuf'
+
+
+def chunk_summary(chunk):
+    """
+    Returns (count, nancount, total, min, max) of an ndarray, where count
+    and total exclude NaNs, and min and max are None if all values are NaN.
+    """
+    if chunk.dtype.kind == 'f':
+        nans = numpy.isnan(chunk)
+        nancount = int(numpy.count_nonzero(nans))
+        if nancount:
+            chunk = chunk[~nans]
+    else:
+        nancount = 0
+
+    if chunk.size == 0:
+        return 0, nancount, 0.0, None, None
+    return (chunk.size, nancount, float(numpy.sum(chunk, dtype='float64')),
+            chunk.min(), chunk.max())
+
+
+def combine_summaries(a, b):
+    """ Combines two results of chunk_summary. """
+    mins = [x for x in (a[3], b[3]) if x is not None]
+    maxs = [x for x in (a[4], b[4]) if x is not None]
+    return (a[0] + b[0], a[1] + b[1], a[2] + b[2],
+            min(mins) if mins else None, max(maxs) if maxs else None)
+
+
+def run_summary(group):
+    """
+    chunk_summary of a run-length encoded group, computed from its runs
+    without expanding them.
+    """
+    length = int(group.attrs['length'])
+    index = group['index'][...]
+    value = group['value'][...]
+    repeats = numpy.diff(numpy.append(index, length))
+    value = value.reshape(len(value), -1)
+
+    if value.dtype.kind == 'f':
+        nans = numpy.isnan(value)
+        nancount = int(numpy.sum(nans.sum(axis=1) * repeats))
+        value = numpy.where(nans, 0, value)
+        valid = (~nans).sum(axis=1) * repeats
+        masked = numpy.ma.masked_array(value, nans)
+    else:
+        nancount = 0
+        valid = value.shape[1] * repeats
+        masked = numpy.ma.masked_array(value, numpy.zeros(value.shape, bool))
+
+    count = int(valid.sum())
+    if count == 0:
+        return 0, nancount, 0.0, None, None
+    total = float(numpy.sum(value.sum(axis=1, dtype='float64') * repeats))
+    return count, nancount, total, masked.min(), masked.max()
+
+
+def summarize(filename, path, workers=1, maxbytes=2**24):
+    """
+    Computes statistics of a dataset by streaming over its chunks.
+
+    Parameters
+    ----------
+    filename : str
+        The HDF5 file.
+
+    path : str
+        The path of the dataset (or run-length encoded group) in the file.
+
+    workers : int
+        Number of worker processes, see hdf5handler.reader.map_chunks.
+
+    maxbytes : int
+        Maximum number of bytes of the dataset in memory per worker.
+
+    Return
+    ------
+    A dict with 'count' (values that are not NaN), 'nancount', 'min', 'max'
+    and 'mean', or None if the dtype is not numeric. min, max and mean are
+    None if there are no values.
+    """
+    with h5py.File(filename, 'r') as h5file:
+        obj = h5file[path]
+        if is_rle(obj):
+            if not is_summarizable(obj['value'].dtype):
+                return None
+            result = run_summary(obj)
+        elif not is_summarizable(obj.dtype):
+            return None
+        elif obj.shape == ():
+            result = chunk_summary(read_rows(obj, 0, 1))
+        else:
+            result = None
+
+    if result is None:
+        result = map_chunks(filename, path, chunk_summary, combine_summaries,
+                            workers, maxbytes)
+    if result is None:
+        result = (0, 0, 0.0, None, None)
+
+    count, nancount, total, vmin, vmax = result
+    return dict(count=count, nancount=nancount, min=vmin, max=vmax,
+                mean=total / count if count else None)
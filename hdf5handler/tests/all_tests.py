@@ -2,10 +2,19 @@
 
 import unittest
 import os
+import operator
+import shutil
+import threading
 import h5py
 import numpy
 
 from hdf5handler import HDF5Handler
+from hdf5handler import chunk_stats, select_chunks, iter_chunks, RunLengthReader
+from hdf5handler import RawFile, raw_to_hdf5, memmap, map_chunks, verify
+from hdf5handler import describe, summarize, recover
+from hdf5handler.cli import main
+from hdf5handler.rawfile import read_header
+from hdf5handler.reader import chunk_ranges, split_chunk_ranges
 
 class test_Base(unittest.TestCase):
     def setUp(self):
@@ -401,3 +410,884 @@ class test_shapes(test_Base):
     pass
     #TODO: test for correct shapes, when using nested lists/tuples
 
+
+class test_chunk_stats(test_Base):
+    def setUp(self):
+        self.filename = 'test.hdf5'
+        self.kwargs = dict(chunksize=10, blockfactor=3, stats=True)
+
+        with HDF5Handler(self.filename) as handler:
+            for value in range(95):
+                handler.put(value, 'test', **self.kwargs)
+
+    def test_stats(self):
+        f = h5py.File(self.filename)
+        stats = chunk_stats(f['test'])
+        self.assertEqual(10, len(stats))
+        self.assertEqual(0, stats['min'][0])
+        self.assertEqual(9, stats['max'][0])
+        self.assertEqual(90, stats['min'][-1])
+        self.assertEqual(94, stats['max'][-1])
+        self.assertEqual(95, stats['count'].sum())
+
+    def test_select_chunks(self):
+        f = h5py.File(self.filename)
+        self.assertEqual([2, 3], list(select_chunks(f['test'], 25, 31)))
+        self.assertEqual([9], list(select_chunks(f['test'], lower=90)))
+        self.assertEqual([0], list(select_chunks(f['test'], upper=9)))
+        self.assertEqual([], list(select_chunks(f['test'], lower=1000)))
+
+    def test_iter_chunks(self):
+        f = h5py.File(self.filename)
+        chunks = list(iter_chunks(f['test'], lower=85))
+        self.assertEqual([80, 90], [begin for begin, chunk in chunks])
+        self.assertEqual(list(range(90, 95)), list(chunks[-1][1]))
+
+    def test_nancount(self):
+        with HDF5Handler(self.filename) as handler:
+            for value in [1.0, numpy.nan, numpy.nan, 2.0, numpy.nan]:
+                handler.put(value, 'test', chunksize=2, stats=True,
+                            nancount=True)
+
+        f = h5py.File(self.filename)
+        stats = chunk_stats(f['test'])
+        self.assertEqual([1, 1, 1], list(stats['nancount']))
+        self.assertTrue(numpy.isnan(stats['min'][2]))
+        self.assertEqual([0, 1], list(select_chunks(f['test'], lower=0)))
+
+    def test_no_stats(self):
+        with HDF5Handler(self.filename) as handler:
+            handler.put(1, 'test')
+
+        f = h5py.File(self.filename)
+        self.assertRaises(KeyError, chunk_stats, f['test'])
+
+
+class test_adaptive_dtype(test_Base):
+    def test_narrowing(self):
+        with HDF5Handler(self.filename) as handler:
+            for value in range(200):
+                handler.put(value, 'counter', dtype='auto', chunksize=10)
+                handler.put([value % 100, -1], 'pairs', dtype='auto',
+                            chunksize=10)
+                handler.put(value/4.0, 'quarters', dtype='auto', chunksize=10)
+
+        f = h5py.File(self.filename)
+        self.assertEqual(numpy.dtype('uint8'), f['counter'].dtype)
+        self.assertEqual(numpy.dtype('int8'), f['pairs'].dtype)
+        self.assertEqual(numpy.dtype('float16'), f['quarters'].dtype)
+        self.assertEqual(list(range(200)), list(f['counter'][...]))
+        self.assertEqual(49.75, f['quarters'][-1])
+
+    def test_widening(self):
+        kwargs = dict(dtype='auto', chunksize=10, blockfactor=2, stats=True)
+        with HDF5Handler(self.filename) as handler:
+            for value in range(100):
+                handler.put(value, 'test', **kwargs)
+            for value in range(100):
+                handler.put(value + 0.5, 'test', **kwargs)
+
+        f = h5py.File(self.filename)
+        self.assertEqual(numpy.dtype('float64'), f['test'].dtype)
+        self.assertEqual(200, len(f['test']))
+        self.assertEqual(list(range(100)), list(f['test'][:100]))
+        self.assertEqual(99.5, f['test'][-1])
+        self.assertEqual(99.5, chunk_stats(f['test'])['max'][-1])
+
+    def test_quantize(self):
+        values = numpy.random.uniform(-100, 100, 1234)
+        with HDF5Handler(self.filename) as handler:
+            for value in values:
+                handler.put(value, 'test', quantize=0.01)
+
+        f = h5py.File(self.filename)
+        self.assertTrue(f['test'].scaleoffset is not None)
+        self.assertTrue(numpy.abs(f['test'][...] - values).max() <= 0.01)
+
+    def test_quantize_integers(self):
+        with HDF5Handler(self.filename) as handler:
+            self.assertRaises(ValueError, handler.put, 1, 'test',
+                              dtype='int32', quantize=0.01)
+
+
+class test_run_length_encoding(test_Base):
+    def setUp(self):
+        self.filename = 'test.hdf5'
+        self.values = numpy.repeat([1.0, 2.5, numpy.nan, 2.5, 7.0],
+                                   [30, 1, 50, 19, 25])
+
+        with HDF5Handler(self.filename) as handler:
+            for value in self.values:
+                handler.put(value, 'setpoint', encoding='rle', chunksize=2)
+                handler.put([value, 0], 'pairs', encoding='rle', chunksize=2)
+
+    def test_changelog(self):
+        f = h5py.File(self.filename)
+        self.assertTrue(isinstance(f['setpoint'], h5py.Group))
+        self.assertEqual([0, 30, 31, 81, 100], list(f['setpoint/index']))
+        self.assertEqual(125, f['setpoint'].attrs['length'])
+
+    def test_dense(self):
+        f = h5py.File(self.filename)
+        setpoint = RunLengthReader(f['setpoint'])
+        self.assertEqual(125, len(setpoint))
+        numpy.testing.assert_array_equal(self.values, setpoint[...])
+        numpy.testing.assert_array_equal(self.values[25:85], setpoint[25:85])
+        numpy.testing.assert_array_equal(self.values[::-7], setpoint[::-7])
+        self.assertEqual((125, 2), RunLengthReader(f['pairs'])[:].shape)
+
+    def test_value_at(self):
+        f = h5py.File(self.filename)
+        setpoint = RunLengthReader(f['setpoint'])
+        self.assertEqual(1.0, setpoint[29])
+        self.assertEqual(2.5, setpoint[30])
+        self.assertTrue(numpy.isnan(setpoint[31]))
+        self.assertEqual(7.0, setpoint[-1])
+        self.assertRaises(IndexError, setpoint.__getitem__, 125)
+
+
+class test_in_memory(test_Base):
+    def test_written_on_close(self):
+        with HDF5Handler(self.filename, in_memory=True) as handler:
+            for value in range(25000):
+                handler.put(value, 'test')
+            self.assertTrue(os.path.getsize(self.filename) < 25000*8)
+
+        f = h5py.File(self.filename)
+        self.assertEqual(list(range(25000)), list(f['test'][...]))
+
+    def test_open_close(self):
+        handler = HDF5Handler(self.filename, in_memory=True)
+        handler.open()
+        for value in range(10):
+            handler.put(value, 'test')
+        handler.close()
+
+        f = h5py.File(self.filename)
+        self.assertEqual(45, f['test'][...].sum())
+
+    def test_max_memory(self):
+        with HDF5Handler(self.filename, in_memory=True,
+                         max_memory=20000) as handler:
+            for value in range(5000):
+                handler.put(value, 'test', chunksize=100, blockfactor=10,
+                            stats=True)
+                handler.put(value // 1000, 'rle', encoding='rle')
+            self.assertFalse(handler.in_memory)
+
+        f = h5py.File(self.filename)
+        self.assertEqual(list(range(5000)), list(f['test'][...]))
+        self.assertEqual(50, len(chunk_stats(f['test'])))
+        self.assertEqual(list(range(5)), list(f['rle/value'][...]))
+
+    def test_max_memory_single_dataset(self):
+        with HDF5Handler(self.filename, in_memory=True,
+                         max_memory=100000) as handler:
+            for value in range(15000):
+                handler.put(float(value), 'test')
+                if value == 10000:
+                    self.assertTrue(handler.in_memory)
+            self.assertFalse(handler.in_memory)
+
+        f = h5py.File(self.filename)
+        self.assertEqual(list(range(15000)), list(f['test'][...]))
+
+    def test_max_memory_put_table(self):
+        with HDF5Handler(self.filename, in_memory=True,
+                         max_memory=100000) as handler:
+            handler.put_table({'a': numpy.arange(300000.)}, 'g')
+            self.assertFalse(handler.in_memory)
+
+        f = h5py.File(self.filename)
+        self.assertEqual(300000, len(f['g/a']))
+
+
+class test_raw_backend(test_Base):
+    def setUp(self):
+        self.filename = 'test.hdf5'
+        self.directory = 'test.raw'
+
+        with HDF5Handler(self.directory, backend='raw') as handler:
+            for value in range(2345):
+                handler.put(value, 'grp/scalars', chunksize=100, stats=True)
+                handler.put([value, -value], 'arrays', chunksize=100)
+                handler.put(value // 1000, 'rle', encoding='rle')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory, ignore_errors=True)
+        test_Base.tearDown(self)
+
+    def test_memmap(self):
+        path = os.path.join(self.directory, 'arrays')
+        data = numpy.memmap(path + '.bin', mode='r',
+                            **read_header(path + '.json'))
+        self.assertEqual((2345, 2), data.shape)
+        self.assertEqual([2344, -2344], list(data[-1]))
+
+    def test_rawfile(self):
+        rawfile = RawFile(self.directory, 'r')
+        self.assertEqual(['_hdf5handler', 'arrays', 'grp', 'rle'],
+                         rawfile.keys())
+        self.assertEqual(2345, len(rawfile['grp/scalars']))
+        self.assertEqual(2344, rawfile['grp']['scalars'][-1])
+        self.assertEqual('rle', rawfile['rle'].attrs['encoding'])
+        self.assertRaises(ValueError, rawfile['arrays'].__getitem__,
+                          slice(None, None, 2))
+        self.assertRaises(TypeError, rawfile['arrays'].__getitem__, (0, 1))
+        rawfile.close()
+
+    def test_raw_to_hdf5(self):
+        raw_to_hdf5(self.directory, self.filename)
+
+        f = h5py.File(self.filename)
+        self.assertEqual(list(range(2345)), list(f['grp/scalars'][...]))
+        self.assertEqual((2345, 2), f['arrays'].shape)
+        self.assertEqual(24, len(chunk_stats(f['grp/scalars'])))
+        self.assertEqual(2.0, RunLengthReader(f['rle'])[2000])
+
+    def test_overwrite(self):
+        os.makedirs('test.notraw')
+        open('test.notraw/data', 'w').close()
+        try:
+            self.assertRaises(IOError, RawFile, 'test.notraw', 'w')
+        finally:
+            shutil.rmtree('test.notraw')
+
+
+class test_put_table(test_Base):
+    def test_columns(self):
+        energy = numpy.random.uniform(0, 10, 2345)
+        position = numpy.random.uniform(0, 1, (2345, 3))
+        kwargs = dict(chunksize=100, blockfactor=4, stats=True)
+
+        with HDF5Handler(self.filename) as handler:
+            handler.put(energy[0], 'events/energy', **kwargs)
+            handler.put(position[0], 'events/position', **kwargs)
+            handler.put_table({'energy': energy[1:7],
+                               'position': position[1:7]}, 'events', **kwargs)
+            handler.put_table({'energy': energy[7:],
+                               'position': position[7:]}, 'events', **kwargs)
+
+        f = h5py.File(self.filename)
+        numpy.testing.assert_array_equal(energy, f['events/energy'][...])
+        numpy.testing.assert_array_equal(position, f['events/position'][...])
+        stats = chunk_stats(f['events/energy'])
+        self.assertEqual(24, len(stats))
+        self.assertEqual(energy[:100].max(), stats['max'][0])
+        self.assertEqual(energy[2300:].min(), stats['min'][-1])
+
+    def test_dataframe_like(self):
+        class Table(object):
+            def items(self):
+                return [('a', [1, 2, 3]), ('b', numpy.array([4, 5, 6]))]
+
+        with HDF5Handler(self.filename) as handler:
+            handler.put_table(Table(), 'table')
+
+        f = h5py.File(self.filename)
+        self.assertEqual([4, 5, 6], list(f['table/b'][...]))
+
+    def test_out_of_step(self):
+        with HDF5Handler(self.filename) as handler:
+            handler.put_table({'a': [1, 2], 'b': [3, 4]}, 'table')
+            handler.put(5, 'table/a')
+            self.assertRaises(AssertionError, handler.put_table,
+                              {'a': [6], 'b': [7]}, 'table')
+            self.assertRaises(ValueError, handler.put_table,
+                              {'a': [6], 'b': [7, 8]}, 'table')
+
+    def test_row_shapes(self):
+        with HDF5Handler(self.filename) as handler:
+            handler.put_table({'a': numpy.arange(3.), 'b': numpy.zeros(3)},
+                              'g')
+            self.assertRaises(ValueError, handler.put_table,
+                              {'a': numpy.arange(3.), 'b': numpy.ones((3, 2)),
+                               'c': numpy.arange(3.)}, 'g')
+            self.assertEqual(3, len(handler.index['g/a']))
+            self.assertEqual(3, len(handler.index['g/b']))
+            self.assertNotIn('g/c', handler.index)
+
+        f = h5py.File(self.filename, 'r')
+        self.assertEqual([0, 1, 2], list(f['g/a'][...]))
+        self.assertNotIn('c', f['g'])
+        f.close()
+
+
+class test_threadsafe(test_Base):
+    def test_concurrent_puts(self):
+        nthreads = 8
+        nputs = 5000
+
+        def producer(handler, n):
+            for value in range(nputs):
+                handler.put(value, 'own/{}'.format(n), chunksize=100)
+                handler.put(value, 'shared', chunksize=100, stats=True)
+
+        with HDF5Handler(self.filename, threadsafe=True) as handler:
+            threads = [threading.Thread(target=producer, args=(handler, n))
+                       for n in range(nthreads)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+
+        f = h5py.File(self.filename)
+        for n in range(nthreads):
+            self.assertEqual(list(range(nputs)), list(f['own/{}'.format(n)]))
+
+        shared = f['shared'][...]
+        self.assertEqual(nthreads*nputs, len(shared))
+        self.assertEqual(nthreads*sum(range(nputs)), shared.sum())
+        self.assertEqual(nthreads*nputs, chunk_stats(f['shared'])['count'].sum())
+
+    def test_flush_during_puts(self):
+        nthreads = 4
+        nputs = 5000
+        done = threading.Event()
+
+        def producer(handler, n):
+            for value in range(nputs):
+                handler.put(float(value), 'p{}'.format(n), chunksize=10)
+
+        def flusher(handler):
+            while not done.is_set():
+                handler.flushbuffers()
+
+        handler = HDF5Handler(self.filename, threadsafe=True)
+        handler.open()
+        threads = [threading.Thread(target=producer, args=(handler, n))
+                   for n in range(nthreads)]
+        flushing = threading.Thread(target=flusher, args=(handler,))
+        for thread in threads + [flushing]:
+            thread.daemon = True # A DEADLOCK MUST NOT KEEP THE TESTS ALIVE
+            thread.start()
+        for thread in threads:
+            thread.join(60)
+        done.set()
+        flushing.join(60)
+
+        self.assertFalse(any(thread.is_alive()
+                             for thread in threads + [flushing]))
+        handler.close()
+
+        f = h5py.File(self.filename)
+        for n in range(nthreads):
+            self.assertEqual(list(range(nputs)), list(f['p{}'.format(n)]))
+
+
+class test_file_space(test_Base):
+    def strategy(self):
+        f = h5py.File(self.filename)
+        fcpl = f.id.get_create_plist()
+        return fcpl.get_file_space_strategy()[0], \
+               fcpl.get_file_space_page_size()
+
+    def test_paged(self):
+        with HDF5Handler(self.filename, fs_strategy='page',
+                         page_buf_size=2**22, meta_block_size=2**16) as handler:
+            handler.put(1, 'test')
+
+        self.assertEqual((h5py.h5f.FSPACE_STRATEGY_PAGE, 2**16),
+                         self.strategy())
+
+    def test_hdf5_defaults(self):
+        with HDF5Handler(self.filename) as handler:
+            handler.put(1, 'test')
+
+        self.assertNotEqual(h5py.h5f.FSPACE_STRATEGY_PAGE, self.strategy()[0])
+
+    def test_append(self):
+        with HDF5Handler(self.filename, fs_strategy='page', fs_page_size=2**12,
+                         page_buf_size=2**16) as handler:
+            handler.put(1, 'first')
+
+        with HDF5Handler(self.filename, 'a') as handler:
+            handler.put(2, 'second')
+
+        self.assertEqual((h5py.h5f.FSPACE_STRATEGY_PAGE, 2**12),
+                         self.strategy())
+        f = h5py.File(self.filename)
+        self.assertEqual(2, f['second'][0])
+
+
+class test_finalize(test_Base):
+    def test_contiguous(self):
+        with HDF5Handler(self.filename, finalize='contiguous') as handler:
+            for value in range(2345):
+                handler.put([value, -value], 'test', chunksize=100)
+                handler.put(value, 'quantized', quantize=0.1)
+                handler.put(value // 1000, 'grp/rle', encoding='rle')
+                handler.put(value, 'grp/stats', chunksize=100, stats=True)
+            handler.put(1, 'single')
+
+        self.assertFalse(os.path.exists(self.filename + '.contiguous~'))
+        f = h5py.File(self.filename)
+        self.assertEqual(None, f['test'].chunks)
+        self.assertEqual((2345, 2), f['test'].shape)
+        self.assertNotEqual(None, f['quantized'].chunks)
+        self.assertEqual([1], list(f['single'][...]))
+        self.assertEqual(None, f['grp/stats'].chunks)
+        self.assertEqual(2344, chunk_stats(f['grp/stats'])['max'][-1])
+        self.assertEqual([0, 1000, 2000], list(f['grp/rle/index'][...]))
+        self.assertEqual(2, RunLengthReader(f['grp/rle'])[-1])
+        f.close()
+
+        data = memmap(self.filename, 'test')
+        self.assertEqual((2345, 2), data.shape)
+        self.assertEqual([1234, -1234], list(data[1234]))
+
+    def test_limit(self):
+        with HDF5Handler(self.filename, finalize='contiguous',
+                         finalize_limit=1000) as handler:
+            for value in range(100):
+                handler.put(value, 'small')
+                handler.put(value, 'large', chunksize=10)
+                handler.put(value, 'large', chunksize=10)
+
+        f = h5py.File(self.filename)
+        self.assertEqual(None, f['small'].chunks)
+        self.assertEqual((10,), f['large'].chunks)
+        self.assertRaises(ValueError, memmap, self.filename, 'large')
+
+    def test_size(self):
+        sizes = list()
+        for finalize in (None, 'contiguous'):
+            with HDF5Handler(self.filename, finalize=finalize) as handler:
+                handler.put_table({'a': numpy.random.random(200000),
+                                   'b': numpy.random.random(200000)}, 'g')
+            sizes.append(os.path.getsize(self.filename))
+        self.assertLessEqual(sizes[1], sizes[0])
+
+
+class test_flush(test_Base):
+    def test_put_after_flush(self):
+        with HDF5Handler(self.filename) as handler:
+            for value in range(15):
+                handler.put(value, 'test', chunksize=10, blockfactor=1,
+                            stats=True)
+            handler.flushbuffers()
+            handler.flushbuffers()
+            for value in range(15, 25):
+                handler.put(value, 'test')
+
+        f = h5py.File(self.filename)
+        self.assertEqual(list(range(25)), list(f['test'][...]))
+        self.assertEqual([10, 10, 5], list(chunk_stats(f['test'])['count']))
+
+
+class test_chunk_policy(test_Base):
+    def setUp(self):
+        self.filename = 'test.hdf5'
+        self.images = numpy.random.uniform(0, 1, (45, 100, 70))
+
+    def put_images(self, chunks):
+        with HDF5Handler(self.filename) as handler:
+            for image in self.images:
+                handler.put(image, 'images', chunksize=20, chunks=chunks,
+                            stats=True)
+
+        f = h5py.File(self.filename)
+        numpy.testing.assert_array_equal(self.images, f['images'][...])
+        self.assertEqual(3, len(chunk_stats(f['images'])))
+        return f['images'].chunks
+
+    def test_append(self):
+        self.assertEqual((20, 100, 70), self.put_images('append'))
+
+    def test_record(self):
+        self.assertEqual((1, 100, 70), self.put_images('record'))
+
+    def test_roi(self):
+        self.assertEqual((20, 64, 64), self.put_images('roi'))
+
+    def test_tuple(self):
+        self.assertEqual((5, 10, 10), self.put_images((5, 10, 10)))
+
+    def test_invalid(self):
+        self.assertRaises(ValueError, self.put_images, (3, 10, 10))
+        self.assertRaises(ValueError, self.put_images, (5, 10))
+        self.assertRaises(ValueError, self.put_images, 'square')
+
+
+class test_read_your_writes(test_Base):
+    def test_get(self):
+        with HDF5Handler(self.filename) as handler:
+            for value in range(1234):
+                handler.put(value, 'test', chunksize=100, blockfactor=5)
+                handler.put([value, -value], 'pairs', chunksize=100)
+                handler.put(value // 100, 'rle', encoding='rle', chunksize=5)
+
+            self.assertEqual(list(range(1234)), list(handler.get('test')))
+            self.assertEqual(list(range(1190, 1210)),
+                             list(handler.get('test', slice(1190, 1210))))
+            self.assertEqual(list(range(1233, 1000, -50)),
+                             list(handler.get('test', slice(None, 1000, -50))))
+            self.assertEqual(1233, handler.get('test', -1))
+            self.assertEqual([1233, -1233], list(handler.get('pairs', -1)))
+            self.assertRaises(IndexError, handler.get, 'test', 1234)
+            self.assertEqual(12, handler.get('rle', -1))
+            self.assertEqual([11, 12], list(handler.get('rle')[[1199, 1200]]))
+
+    def test_tail(self):
+        with HDF5Handler(self.filename) as handler:
+            handler.prefix = 'prefix/'
+            for value in range(250):
+                handler.put(value, 'test', chunksize=100, blockfactor=2)
+                if value == 10:
+                    self.assertEqual(list(range(11)),
+                                     list(handler.tail('test', 100)))
+
+            self.assertEqual(list(range(195, 250)),
+                             list(handler.tail('test', 55)))
+            self.assertEqual((0,), handler.tail('test', 0).shape)
+
+            # Never reads the preallocated rows
+            self.assertEqual(400, handler.file['prefix/test'].shape[0])
+            self.assertEqual(250, len(handler.tail('test', 1000)))
+
+        f = h5py.File(self.filename)
+        self.assertEqual(250, len(f['prefix/test']))
+
+    def test_adaptive(self):
+        with HDF5Handler(self.filename) as handler:
+            handler.put(1, 'x', dtype='auto')
+            handler.put(2.5, 'x')
+            self.assertEqual([1.0, 2.5], list(handler.get('x')))
+
+            for value in range(100):
+                handler.put(value, 'a', chunksize=100, dtype='auto')
+            self.assertEqual(numpy.dtype('uint8'), handler.file['a'].dtype)
+            handler.put(300, 'a')
+            self.assertEqual([98, 99, 300], list(handler.tail('a', 3)))
+            self.assertEqual(99, handler.get('a', 99))
+
+        f = h5py.File(self.filename)
+        self.assertEqual([1.0, 2.5], list(f['x']))
+        self.assertEqual(300, f['a'][-1])
+
+
+def histogram(chunk):
+    return numpy.histogram(chunk, bins=10, range=(0, 1000))[0]
+
+
+class test_map_chunks(test_Base):
+    def setUp(self):
+        self.filename = 'test.hdf5'
+        self.values = numpy.random.uniform(0, 1000, 12345)
+
+        with HDF5Handler(self.filename) as handler:
+            for value in self.values:
+                handler.put(value, 'test', chunksize=100)
+
+    def test_sum(self):
+        for workers in (1, 3):
+            total = map_chunks(self.filename, 'test', numpy.sum,
+                               reduce=operator.add, workers=workers)
+            self.assertAlmostEqual(self.values.sum(), total, places=6)
+
+    def test_histogram(self):
+        counts = map_chunks(self.filename, 'test', histogram,
+                            reduce=operator.add, workers=2)
+        self.assertEqual(12345, counts.sum())
+        numpy.testing.assert_array_equal(histogram(self.values), counts)
+
+    def test_no_reduce(self):
+        lengths = map_chunks(self.filename, 'test', len, workers=2)
+        self.assertEqual([100]*123 + [45], lengths)
+
+    def test_small_maxbytes(self):
+        # 256 bytes are 32 rows, which does not divide the chunks of 100.
+        lengths = map_chunks(self.filename, 'test', len, workers=2,
+                             maxbytes=256)
+        self.assertEqual(([32]*3 + [4])*123 + [32, 13], lengths)
+
+        total = map_chunks(self.filename, 'test', numpy.sum,
+                           reduce=operator.add, workers=3, maxbytes=256)
+        self.assertAlmostEqual(self.values.sum(), total, places=6)
+
+        f = h5py.File(self.filename, 'r')
+        ranges = chunk_ranges(f['test'], 256)
+        groups = split_chunk_ranges(f['test'], ranges, 40)
+        f.close()
+        self.assertEqual(ranges, [item for group in groups for item in group])
+        chunks = [set(begin // 100 for begin, end in group)
+                  for group in groups]
+        self.assertEqual(124, sum(len(group) for group in chunks))
+
+
+class test_verify(test_Base):
+    def setUp(self):
+        self.filename = 'test.hdf5'
+
+        with HDF5Handler(self.filename) as handler:
+            for value in range(1234):
+                handler.put(value, 'crc', chunksize=100, checksum=True)
+                handler.put([value, value], 'sha', chunksize=100,
+                            checksum='sha1', chunks='record')
+                handler.put(value, 'fletcher', chunksize=100, fletcher32=True)
+                handler.put(value, 'auto', chunksize=100, dtype='auto',
+                            checksum=True)
+                handler.put(value, 'plain', chunksize=100)
+
+    def corrupt(self, path, chunk):
+        f = h5py.File(self.filename, 'r')
+        offset = f[path].id.get_chunk_info(chunk).byte_offset
+        f.close()
+
+        with open(self.filename, 'r+b') as datafile:
+            datafile.seek(offset + 10)
+            byte = bytearray(datafile.read(1))
+            byte[0] ^= 0xff
+            datafile.seek(offset + 10)
+            datafile.write(byte)
+
+    def test_intact(self):
+        report = verify(self.filename, workers=2)
+        self.assertEqual({'/crc': [], '/sha': [], '/fletcher': [],
+                          '/auto': []}, report)
+        self.assertEqual(0, main(['verify', self.filename, '-w', '1']))
+
+    def test_corrupted(self):
+        self.corrupt('crc', 3)
+        self.corrupt('crc', 4)
+        self.corrupt('fletcher', 12)
+        self.corrupt('auto', 0)
+        self.corrupt('sha', 1000)
+
+        report = verify(self.filename, workers=2)
+        self.assertEqual([(300, 500)], report['/crc'])
+        self.assertEqual([(1200, 1234)], report['/fletcher'])
+        self.assertEqual([(0, 100)], report['/auto'])
+        self.assertEqual([(1000, 1100)], report['/sha'])
+        self.assertEqual(1, main(['verify', self.filename, '-w', '1']))
+
+
+class test_summary(test_Base):
+    def setUp(self):
+        self.filename = 'test.hdf5'
+
+        with HDF5Handler(self.filename) as handler:
+            for value in range(1234):
+                handler.put(float(value), 'grp/float', chunksize=100,
+                            stats=True)
+                handler.put([value, -value], 'grp/pairs', chunksize=100)
+                handler.put(value // 100, 'setpoint', encoding='rle')
+            for value in (1.0, float('nan'), 3.0):
+                handler.put(value, 'nans')
+
+    def test_describe(self):
+        f = h5py.File(self.filename, 'r')
+        info = describe(f['grp/float'])
+        self.assertEqual((1234,), info['shape'])
+        self.assertEqual((100,), info['chunks'])
+        self.assertEqual(['stats'], info['sidecars'])
+        self.assertEqual(1234*8, info['nbytes'])
+
+        info = describe(f['setpoint'])
+        self.assertEqual('rle', info['kind'])
+        self.assertEqual((1234,), info['shape'])
+        self.assertEqual(13, info['runs'])
+        f.close()
+
+    def test_summarize(self):
+        for workers in (1, 2):
+            stats = summarize(self.filename, 'grp/float', workers=workers,
+                              maxbytes=256)
+            self.assertEqual(1234, stats['count'])
+            self.assertEqual(0.0, stats['min'])
+            self.assertEqual(1233.0, stats['max'])
+            self.assertAlmostEqual(616.5, stats['mean'])
+
+        stats = summarize(self.filename, 'grp/pairs')
+        self.assertEqual(2468, stats['count'])
+        self.assertEqual((-1233, 1233), (stats['min'], stats['max']))
+        self.assertAlmostEqual(0.0, stats['mean'])
+
+        stats = summarize(self.filename, 'nans')
+        self.assertEqual((2, 1), (stats['count'], stats['nancount']))
+        self.assertEqual(2.0, stats['mean'])
+
+    def test_summarize_rle(self):
+        stats = summarize(self.filename, 'setpoint')
+        expected = numpy.arange(1234) // 100
+        self.assertEqual(1234, stats['count'])
+        self.assertEqual((0, 12), (stats['min'], stats['max']))
+        self.assertAlmostEqual(expected.mean(), stats['mean'])
+
+    def test_cli(self):
+        for command in ('ls', 'info', 'summary'):
+            self.assertEqual(0, main([command, self.filename]))
+        self.assertEqual(0, main(['summary', self.filename, 'grp', '-w', '2',
+                                  '-m', '0.001']))
+        self.assertEqual(0, main(['ls', self.filename, '--all']))
+
+    def test_scalar_datasets(self):
+        f = h5py.File(self.filename, 'a')
+        f['scalar'] = 2.5
+        f['empty'] = h5py.Empty('float64')
+        f.close()
+
+        for command in ('ls', 'info', 'summary'):
+            self.assertEqual(0, main([command, self.filename]))
+
+        f = h5py.File(self.filename, 'r')
+        info = describe(f['scalar'])
+        self.assertEqual((), info['shape'])
+        self.assertEqual(8, info['nbytes'])
+        self.assertEqual(None, info['chunks'])
+        self.assertEqual(0, describe(f['empty'])['nbytes'])
+        f.close()
+
+        stats = summarize(self.filename, 'scalar')
+        self.assertEqual((1, 2.5, 2.5), (stats['count'], stats['min'],
+                                         stats['max']))
+        self.assertEqual(0, summarize(self.filename, 'empty')['count'])
+        self.assertEqual([1], map_chunks(self.filename, 'scalar', len,
+                                         workers=1))
+
+
+class test_scalar_puts(test_Base):
+    def test_scalar_types(self):
+        values = [1, 2.5, True, numpy.float32(0.25), numpy.int8(-3),
+                  numpy.bool_(False), numpy.array(7.0)]
+
+        with HDF5Handler(self.filename) as handler:
+            for value in values*100:
+                handler.put(value, 'mixed', chunksize=70)
+            for value in range(250):
+                handler.put(value, 'ints', chunksize=100, dtype='int16')
+            self.assertEqual(7, handler.get('mixed', 6))
+            self.assertEqual(249, handler.get('ints', -1))
+
+        f = h5py.File(self.filename)
+        expected = numpy.array([float(value) for value in values]*100)
+        self.assertTrue(numpy.array_equal(expected, f['mixed'][...]))
+        self.assertEqual(numpy.dtype('int16'), f['ints'].dtype)
+        self.assertTrue(numpy.array_equal(numpy.arange(250), f['ints'][...]))
+
+    def test_extend_and_flush(self):
+        with HDF5Handler(self.filename) as handler:
+            for value in range(30):
+                handler.put(float(value), 'grp/dset', chunksize=20, stats=True)
+            handler.put_table({'dset': numpy.arange(30, 75)}, 'grp')
+            handler.flushbuffers()
+            for value in range(75, 110):
+                handler.put(value, 'grp/dset')
+            self.assertEqual(110, len(handler.index['grp/dset']))
+
+        f = h5py.File(self.filename)
+        self.assertTrue(numpy.array_equal(numpy.arange(110), f['grp/dset'][...]))
+        self.assertEqual([19.0, 39.0, 59.0, 79.0, 99.0, 109.0],
+                         list(chunk_stats(f['grp/dset'])['max']))
+
+
+class test_checkpoint(test_Base):
+    def crash(self, nrows, **kwargs):
+        """ Puts nrows rows and lets the writer die without closing. """
+        pid = os.fork()
+        if pid == 0:
+            handler = HDF5Handler(self.filename, **kwargs)
+            handler.open()
+            for value in range(nrows):
+                handler.put(float(value), 'grp/scalars', chunksize=100,
+                            stats=True, checksum=True)
+                handler.put([value, value], 'pairs', chunksize=100)
+                handler.put(self.setpoint(value), 'setpoint', chunksize=100,
+                            encoding='rle')
+            os._exit(0)
+        os.waitpid(pid, 0)
+
+    def setpoint(self, i):
+        """ A slowly changing value, which is NaN for a while. """
+        return float('nan') if 500 <= i < 600 else float(i // 250)
+
+    def assertSetpoint(self, length):
+        f = h5py.File(self.filename, 'r')
+        values = RunLengthReader(f['setpoint'])[...]
+        expected = [self.setpoint(i) for i in range(length)]
+        self.assertTrue(numpy.array_equal(numpy.array(expected), values,
+                                          equal_nan=True))
+        starts = [i for i in (0, 250, 500, 600, 750, 1000) if i < length]
+        self.assertEqual(starts, list(f['setpoint/index'][...]))
+        f.close()
+
+    def tearDown(self):
+        test_Base.tearDown(self)
+        if os.path.exists(self.filename + '.wal'):
+            shutil.rmtree(self.filename + '.wal')
+
+    def test_recover_from_log(self):
+        self.crash(1234, checkpoint=1, wal=True)
+        self.assertEqual({'/grp/scalars': 1234, '/pairs': 1234,
+                          '/setpoint': 1234}, recover(self.filename))
+        self.assertSetpoint(1234)
+        self.assertFalse(os.path.exists(self.filename + '.wal'))
+
+        f = h5py.File(self.filename, 'r')
+        self.assertTrue(numpy.array_equal(numpy.arange(1234),
+                                          f['grp/scalars'][...]))
+        self.assertEqual([1233, 1233], list(f['pairs'][-1]))
+        self.assertEqual(1234, chunk_stats(f['grp/scalars'])['count'].sum())
+        f.close()
+        self.assertEqual({'/grp/scalars': []}, verify(self.filename,
+                                                      workers=1))
+
+    def test_recover_to_checkpoint(self):
+        self.crash(1150, checkpoint=3)
+        self.assertEqual({'/grp/scalars': 900, '/pairs': 900,
+                          '/setpoint': 900}, recover(self.filename))
+        self.assertSetpoint(900)
+
+        f = h5py.File(self.filename, 'r')
+        self.assertTrue(numpy.array_equal(numpy.arange(900),
+                                          f['grp/scalars'][...]))
+        self.assertEqual(9, len(chunk_stats(f['grp/scalars'])))
+        f.close()
+
+    def test_valid_length(self):
+        with HDF5Handler(self.filename, checkpoint=2, wal=True) as handler:
+            for value in range(450):
+                handler.put(value, 'dset', chunksize=100, blockfactor=10)
+            f = h5py.File(self.filename, 'r')
+            self.assertEqual(1000, f['dset'].shape[0])
+            self.assertEqual(400, map_chunks(self.filename, 'dset', len,
+                                             operator.add, workers=1))
+            f.close()
+
+        self.assertFalse(os.path.exists(self.filename + '.wal'))
+        self.assertEqual(0, main(['recover', self.filename]))
+        f = h5py.File(self.filename, 'r')
+        self.assertEqual(450, f['dset'].attrs['valid_length'])
+        self.assertEqual(450, len(f['dset']))
+        f.close()
+
+    def test_in_memory(self):
+        self.assertRaises(ValueError, HDF5Handler, self.filename,
+                          in_memory=True, checkpoint=1)
+
+    def test_live_writer(self):
+        ready_r, ready_w = os.pipe()
+        done_r, done_w = os.pipe()
+        pid = os.fork()
+        if pid == 0:
+            handler = HDF5Handler(self.filename, checkpoint=1, wal=True)
+            handler.open()
+            for value in range(250):
+                handler.put(float(value), 'scalars', chunksize=100)
+            os.write(ready_w, b'x')
+            os.read(done_r, 1) # DIE ONCE THE PARENT HAS TRIED TO RECOVER
+            os._exit(0)
+
+        os.read(ready_r, 1)
+        with open(self.filename, 'rb') as h5file:
+            before = h5file.read()
+        self.assertRaises((IOError, OSError), recover, self.filename)
+        with open(self.filename, 'rb') as h5file:
+            self.assertEqual(before, h5file.read())
+        self.assertTrue(os.path.exists(self.filename + '.wal'))
+
+        os.write(done_w, b'x')
+        os.waitpid(pid, 0)
+        for fd in (ready_r, ready_w, done_r, done_w):
+            os.close(fd)
+        self.assertEqual({'/scalars': 250}, recover(self.filename))
@@ -0,0 +1,157 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Integrity verification of files written by the HDF5Handler with
+put(..., checksum=...) and/or put(..., fletcher32=True):
+
+    $ hdf5handler verify mydata.hdf5 --workers 16
+
+Datasets with a checksums sidecar are verified by recomputing the digest of
+every chunk. If the HDF5 chunks are the chunks that were digested and are not
+compressed, they are read raw, without HDF5's filter pipeline. Datasets with
+the fletcher32 filter are verified by reading every chunk, which makes HDF5
+check the fletcher32 checksum.
+"""
+
+import multiprocessing
+import h5py
+
+from .sidecars import METADATA_GROUP, ChunkChecksums, sidecar_path
+from .sidecars import get_digest, chunk_bytes
+from .reader import get_length, chunk_ranges, split_ranges, parallel_map
+from .reader import split_chunk_ranges
+
+
+def checked_datasets(h5file):
+    """
+    Returns the paths of all datasets in h5file that have a checksums sidecar
+    or the fletcher32 filter.
+    """
+    paths = list()
+
+    def visit(name, obj):
+        if name.split('/')[0] == METADATA_GROUP:
+            return
+        if isinstance(obj, h5py.Dataset):
+            if obj.fletcher32 or \
+               sidecar_path(ChunkChecksums.kind, obj.name) in h5file:
+                paths.append(obj.name)
+
+    h5file.visititems(visit)
+    return paths
+
+
+def digest_ranges(dset, sidecar):
+    """ The (begin, end) row ranges of the digests in sidecar. """
+    chunksize = int(sidecar.attrs['chunksize'])
+    length = get_length(dset)
+    return [(begin, min(begin + chunksize, length))
+            for begin in range(0, length, chunksize)][:len(sidecar)]
+
+
+def is_raw_readable(dset, chunksize):
+    """
+    True if the HDF5 chunks of dset are the digested chunks, stored without
+    transformation (fletcher32 only appends a checksum).
+    """
+    return dset.chunks == (chunksize,) + dset.shape[1:] and \
+           dset.compression is None and dset.scaleoffset is None and \
+           not dset.shuffle
+
+
+def _verify_ranges(args):
+    """ Worker of verify. Returns the corrupted ranges. """
+    filename, path, ranges = args
+
+    corrupted = list()
+    with h5py.File(filename, 'r') as h5file:
+        dset = h5file[path]
+        spath = sidecar_path(ChunkChecksums.kind, dset.name)
+        sidecar = h5file[spath] if spath in h5file else None
+
+        if sidecar is not None:
+            chunksize = int(sidecar.attrs['chunksize'])
+            digest = get_digest(sidecar.attrs['algorithm'])[1]
+            raw = is_raw_readable(dset, chunksize)
+            offset = (0,)*(len(dset.shape) - 1)
+            rowsize = dset.dtype.itemsize * (dset.size // max(1, len(dset)))
+
+        for begin, end in ranges:
+            try:
+                if sidecar is None:
+                    dset[begin:end, ...] # HDF5 checks fletcher32
+                    continue
+                elif raw:
+                    chunk = dset.id.read_direct_chunk((begin,) + offset)[1]
+                    data = chunk[:(end - begin)*rowsize]
+                else:
+                    data = chunk_bytes(dset[begin:end, ...], dset.dtype)
+                expected = sidecar[begin // chunksize].tobytes()
+                if digest(data) == expected:
+                    continue
+            except (IOError, OSError, ValueError, KeyError):
+                pass
+            corrupted.append((begin, end))
+
+    return path, corrupted
+
+
+def merge_ranges(ranges):
+    """ Merges adjacent (begin, end) ranges. """
+    merged = list()
+    for begin, end in sorted(ranges):
+        if merged and merged[-1][1] == begin:
+            merged[-1] = (merged[-1][0], end)
+        else:
+            merged.append((begin, end))
+    return merged
+
+
+def verify(filename, paths=None, workers=None):
+    """
+    Verifies the chunks of datasets in parallel processes.
+
+    Parameters
+    ----------
+    filename : str
+        The HDF5 file.
+
+    paths : list of str
+        The datasets to verify. None means all datasets that have a checksums
+        sidecar or the fletcher32 filter.
+
+    workers : int
+        Number of worker processes. None means one per CPU, 1 means that
+        everything is done in this process.
+
+    Return
+    ------
+    A dict {path: list of corrupted (begin, end) row ranges}, with an empty
+    list for every dataset that is intact.
+    """
+    if workers is None:
+        workers = multiprocessing.cpu_count()
+
+    tasks = list()
+    with h5py.File(filename, 'r') as h5file:
+        if paths is None:
+            paths = checked_datasets(h5file)
+
+        for path in paths:
+            dset = h5file[path]
+            spath = sidecar_path(ChunkChecksums.kind, dset.name)
+            if spath in h5file:
+                groups = split_ranges(digest_ranges(dset, h5file[spath]),
+                                      4*workers)
+            else:
+                groups = split_chunk_ranges(dset, chunk_ranges(dset),
+                                            4*workers)
+            for group in groups:
+                tasks.append((filename, path, group))
+
+    report = dict((path, list()) for path in paths)
+    for path, corrupted in parallel_map(_verify_ranges, tasks, workers):
+        report[path].extend(corrupted)
+
+    return dict((path, merge_ranges(ranges))
+                for path, ranges in report.items())
@@ -39,6 +39,7 @@ setup(
     name = "hdf5handler",
     version = "0.0.1",
     packages = ['hdf5handler'],
+    entry_points = {'console_scripts': ['hdf5handler = hdf5handler.cli:main']},
     cmdclass = {'clean': CleanCommand,
                 'test': TestCommand,}
 )